@@ -1,16 +1,38 @@
+import time # We'll use this for a simple progress bar (and our timing report)
+run_started_at = time.perf_counter()
+
 import streamlit as st
 import subprocess
 import tempfile
+import shutil
+import re
+import logging
+import html
+import sqlite3
+import hashlib
+import os
 import pandas as pd
+import numpy as np
 from pathlib import Path
-import google.generativeai as genai
 from streamlit.column_config import SelectboxColumn
-import time # We'll use this for a simple progress bar
-from openpyxl import load_workbook
-from openpyxl.utils.exceptions import InvalidFileException
-import xlsxwriter
-import altair as alt
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+# NOTE: The heavy libraries (google.generativeai, altair, openpyxl, xlsxwriter, pyarrow)
+# are imported inside the code that needs them, so a rerun that never touches
+# the AI / charts / Excel export doesn't pay to load them.
+
+# --- RUN TIMING ---
+# How long each part of this script run took (shown in the sidebar's "Performance" box)
+run_timings = {}
+last_timing_mark = run_started_at
+
+def mark_timing(section_name):
+    """Records how long it has been since the previous mark, under section_name."""
+    global last_timing_mark
+    now = time.perf_counter()
+    run_timings[section_name] = now - last_timing_mark
+    last_timing_mark = now
+
+mark_timing("Imports")
 
 st.set_page_config(
     page_title="Woshi's Finance Tracker",
@@ -19,8 +41,8 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-st.markdown(
-    """
+# --- CUSTOM CSS (sent to the browser in ONE call, see below) ---
+GLASS_SIDEBAR_AND_BUTTON_CSS = """
     <style>
     /* Target the sidebar */
     section[data-testid="stSidebar"] {
@@ -67,12 +89,10 @@ st.markdown(
         filter: brightness(0.9);
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
 
 # --- CUSTOM CSS FOR "MODERN & CLEAN" VIBE ---
-st.markdown("""
+MODERN_CLEAN_CSS = """
 <style>
 /* --- 1. THE FONT --- */
 @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;700&display=swap');
@@ -141,7 +161,9 @@ st.markdown("""
 }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(GLASS_SIDEBAR_AND_BUTTON_CSS + MODERN_CLEAN_CSS, unsafe_allow_html=True)
 # --- END OF CUSTOM CSS ---
 
 def format_time(seconds):
@@ -161,35 +183,118 @@ def format_time(seconds):
 
 
 # --- AI CONFIGURATION ---
-# Configure the Gemini AI client using our secret key
+# Make sure our secret key is there (the client itself is only built when the AI is first used)
 try:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-    model = genai.GenerativeModel('models/gemini-2.5-flash-lite')
+    st.secrets["GEMINI_API_KEY"]
 except Exception as e:
     # If the key is missing, show an error in the sidebar
     st.sidebar.error("GEMINI_API_KEY not found in .streamlit/secrets.toml")
     st.stop() # Stop the app if AI can't be loaded
 
+DEFAULT_TOKENS_PER_MINUTE = 250_000 # Gemini Flash-Lite's free-tier limits; change them in the sidebar
+DEFAULT_REQUESTS_PER_MINUTE = 15
+EXPECTED_TOKENS_PER_CALL = 100 # Our guess for the first call of a job (the prompt is tiny)
+
+def build_category_instruction(categories_list):
+    """
+    The part of the prompt that's the SAME for every transaction. It's sent as the
+    model's system instruction, so each call only adds the transaction itself
+    (and the shared prefix can be cached by Gemini).
+    """
+    return (
+        "You label bank transactions. Categories: " + ", ".join(categories_list) + ". "
+        "Reply with exactly one category name from that list and nothing else."
+    )
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_gemini_model(categories):
+    """
+    Configures the Gemini AI client using our secret key.
+    Cached (per category list), so this happens ONCE instead of on every rerun.
+    """
+    import google.generativeai as genai
+    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    return genai.GenerativeModel(
+        'models/gemini-2.5-flash-lite',
+        system_instruction=build_category_instruction(list(categories))
+    )
+
+# --- TOKEN ACCOUNTING ---
+def new_token_usage():
+    """An empty token tally for one AI job."""
+    return {'calls': 0, 'prompt': 0, 'output': 0, 'cached': 0, 'total': 0, 'last_call': 0}
+
+def record_token_usage(response):
+    """Adds one response's usage metadata to this job's tally (and the last-minute window)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        st.session_state.token_window.append((time.time(), 0)) # Still counts as a call
+        return
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    total_tokens = getattr(usage, 'total_token_count', 0) or (prompt_tokens + output_tokens)
+
+    tally = st.session_state.token_usage
+    tally['calls'] += 1
+    tally['prompt'] += prompt_tokens
+    tally['output'] += output_tokens
+    tally['cached'] += getattr(usage, 'cached_content_token_count', 0) or 0
+    tally['total'] += total_tokens
+    tally['last_call'] = total_tokens
+    st.session_state.token_window.append((time.time(), total_tokens))
+
+def describe_token_usage(tally):
+    """A one-line summary of a token tally, for the UI."""
+    return (
+        f"**{tally['total']:,} tokens** over {tally['calls']:,} AI call(s) "
+        f"(prompt {tally['prompt']:,} · output {tally['output']:,} · cached {tally['cached']:,})"
+    )
+
+def expected_tokens_per_call(tally):
+    """What a typical AI call costs, going by this job so far."""
+    return tally['total'] / tally['calls'] if tally['calls'] else EXPECTED_TOKENS_PER_CALL
+
+def seconds_per_ai_call(tally, tokens_per_minute, requests_per_minute):
+    """Our sustained pace: whichever budget (calls or tokens per minute) runs out first sets it."""
+    return max(60 / requests_per_minute, 60 * expected_tokens_per_call(tally) / tokens_per_minute)
+
+def wait_for_ai_budget(tokens_per_minute, requests_per_minute, status_placeholder):
+    """
+    Holds off the next AI call until it fits in our per-minute budgets.
+    We look at the calls (and tokens) of the last 60 seconds, plus what a typical call costs.
+    """
+    expected_tokens = expected_tokens_per_call(st.session_state.token_usage)
+    while True:
+        now = time.time()
+        st.session_state.token_window = [(at, tokens) for at, tokens in st.session_state.token_window if now - at < 60]
+        window = st.session_state.token_window
+        if not window:
+            return
+        calls_fit = len(window) + 1 <= requests_per_minute
+        tokens_fit = sum(tokens for _, tokens in window) + expected_tokens <= tokens_per_minute
+        if calls_fit and tokens_fit:
+            return
+        # Wait until the oldest call drops out of the 60-second window
+        wait_seconds = max(1, int(60 - (now - window[0][0])) + 1)
+        used_up = "Call" if not calls_fit else "Token"
+        status_placeholder.warning(f"{used_up} budget for this minute is used up... waiting {wait_seconds}s")
+        time.sleep(min(wait_seconds, 5))
+
 # --- HELPER FUNCTIONS ---
 def get_ai_category(description, categories_list):
     """
     Takes a transaction description and a list of categories,
     and asks the Gemini AI to pick the best one.
+    Returns None (not "None"!) if the call itself failed, e.g. a 429, so the
+    caller knows not to remember that answer for the merchant.
+    (The categories and instructions live in the model's system instruction,
+    so the prompt itself is just the transaction.)
     """
-    category_string = ", ".join(categories_list)
-    
-    prompt = f"""
-    Given the following transaction description: "{description}"
-    
-    Please classify it into one of the following categories:
-    {category_string}
-    
-    Your response should be *only* the single, best-matching category name
-    from that list, and nothing else.
-    """
+    prompt = f"Transaction: {description}"
     
     try:
-        response = model.generate_content(prompt)
+        response = get_gemini_model(tuple(categories_list)).generate_content(prompt)
+        record_token_usage(response)
         # Clean the AI's response (remove extra spaces/newlines)
         ai_guess = response.text.strip()
         
@@ -199,36 +304,1108 @@ def get_ai_category(description, categories_list):
         else:
             return "None"
     except Exception as e:
+        st.session_state.token_window.append((time.time(), 0)) # A failed call still counts against the quota
         st.error(f"AI processing failed for: {description}. Error: {e}")
-        return "None"
-
-def process_files_to_dataframe(uploaded_files):
-    all_data = []
-    for file in uploaded_files:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_dir_path = Path(temp_dir)
-            input_pdf_path = temp_dir_path / file.name
-            input_pdf_path.write_bytes(file.getvalue())
-
-            command = ["monopoly", str(input_pdf_path), "-o", str(temp_dir_path)]
-            subprocess.run(command, check=True, capture_output=True, text=True)
-
-            csv_files = list(temp_dir_path.glob("*.csv"))
-            if csv_files:
-                data = pd.read_csv(csv_files[0])
-                all_data.append(data)
-    
-    if all_data:
-        return pd.concat(all_data, ignore_index=True)
-    return None
+        return None
+
+# --- STATEMENT INGEST (PDF via monopoly, CSV/OFX/QIF read directly) ---
+STATEMENT_FORMATS = {'.pdf': 'pdf', '.csv': 'csv', '.ofx': 'ofx', '.qfx': 'ofx', '.qif': 'qif'}
+STATEMENT_COLUMNS = ['date', 'description', 'amount']
+# Two rows with the same date, description and amount are the same transaction
+# (e.g. the same statement uploaded twice). See duplicate_keys() for the opt-in
+# looser match that also catches one statement imported as PDF *and* as CSV.
+DUPLICATE_KEY = ['date', 'description', 'amount']
+CSV_CHUNK_ROWS = 50_000 # Big CSV exports are read this many rows at a time
+
+# Header names we try (lower-cased) when the user hasn't mapped a CSV column
+CSV_COLUMN_GUESSES = {
+    'date': ['date', 'transaction date', 'trans date', 'posting date', 'posted date', 'value date'],
+    'description': ['description', 'payee', 'details', 'narrative', 'merchant', 'name', 'memo'],
+    'amount': ['amount', 'transaction amount', 'amount (usd)', 'value']
+}
+
+def detect_statement_format(file):
+    """Works out what kind of statement a file is (by extension, then by peeking at it)."""
+    suffix = Path(file.name).suffix.lower()
+    if suffix in STATEMENT_FORMATS:
+        return STATEMENT_FORMATS[suffix]
+
+    file.seek(0)
+    head = file.read(512).lstrip().upper()
+    file.seek(0)
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head.startswith(b'OFXHEADER') or b'<OFX>' in head:
+        return 'ofx'
+    if head.startswith(b'!TYPE') or head.startswith(b'!ACCOUNT'):
+        return 'qif'
+    return 'csv'
+
+def clean_amounts(amounts):
+    """Turns things like "$1,234.56" or "(12.00)" into numbers."""
+    if pd.api.types.is_numeric_dtype(amounts):
+        return amounts
+    amounts = amounts.astype(str).str.strip()
+    is_negative = amounts.str.startswith('(') & amounts.str.endswith(')')
+    amounts = pd.to_numeric(amounts.str.replace(r'[^0-9.\-]', '', regex=True), errors='coerce')
+    return amounts.where(~is_negative, -amounts.abs())
+
+# "Date order" choices in the CSV Import Settings (None = work it out from the file)
+CSV_DATE_ORDERS = {
+    'Detect from the file': None,
+    'Day first (31/01/2025)': 'day',
+    'Month first (01/31/2025)': 'month'
+}
+
+DATE_TIME_SUFFIX = re.compile(r'[ T]\d{1,2}:\d{2}.*$') # " 10:30", "T10:30:00Z", ...
+NUMERIC_DATE_PATTERN = re.compile(r'^(\d{1,4})([-/.])(\d{1,2})\2(\d{1,4})$') # 31/01/2025, 2025-01-31, 1.31.25, ...
+
+def date_strings(dates):
+    """The date part of each value, as text (any time of day is dropped)."""
+    return dates.astype("string").str.strip().str.replace(DATE_TIME_SUFFIX, "", regex=True)
+
+def infer_date_format(dates, date_order=None):
+    """
+    Works out the ONE date format a file uses, so "05/03/2025" and "13/03/2025"
+    in the same file are read the same way. date_order is 'day', 'month' or None
+    (then we look at every date: a "13" in the first spot means day-first).
+    Raises ValueError if the dates fit day-first and month-first equally well.
+    """
+    from pandas.tseries.api import guess_datetime_format
+
+    samples = date_strings(pd.Series(dates.dropna().unique())).dropna()
+    samples = samples[samples != ""]
+    if samples.empty:
+        return None
+
+    parts = samples.str.extract(NUMERIC_DATE_PATTERN).dropna()
+    if parts.empty:
+        # Month names ("5 Mar 2025", "Mar 5, 2025") or "20250131" can't be mixed up
+        date_format = guess_datetime_format(samples.iloc[0], dayfirst=date_order == 'day')
+        if date_format is None:
+            raise ValueError(f"couldn't read dates like '{samples.iloc[0]}'")
+        return date_format
+
+    first, separator, _, last = parts.iloc[0]
+    if len(first) == 4:
+        return f"%Y{separator}%m{separator}%d"
+    year = "%Y" if len(last) == 4 else "%y"
+
+    if date_order is None:
+        first_numbers = parts[0].astype(int)
+        second_numbers = parts[2].astype(int)
+        could_be_day_first = (first_numbers <= 31).all() and (second_numbers <= 12).all()
+        could_be_month_first = (first_numbers <= 12).all() and (second_numbers <= 31).all()
+        if could_be_day_first and could_be_month_first and not (first_numbers == second_numbers).all():
+            raise ValueError(
+                f"dates like '{samples.iloc[0]}' could be day-first or month-first - "
+                "set the date order under 'CSV Import Settings'"
+            )
+        if not (could_be_day_first or could_be_month_first):
+            raise ValueError(f"couldn't read dates like '{samples.iloc[0]}'")
+        date_order = 'day' if could_be_day_first else 'month'
+
+    if date_order == 'day':
+        return f"%d{separator}%m{separator}{year}"
+    return f"%m{separator}%d{separator}{year}"
+
+def tidy_statement_frame(data, date_format=None):
+    """
+    Gives every ingest path the same date/description/amount frame.
+    Text dates are read with date_format (or the one format inferred from the data).
+    """
+    data = data[STATEMENT_COLUMNS].copy()
+    if not pd.api.types.is_datetime64_any_dtype(data['date']):
+        date_format = date_format or infer_date_format(data['date'])
+        # Dates repeat a lot, so each distinct one is only cleaned and parsed once
+        codes, unique_dates = pd.factorize(data['date'])
+        parsed = pd.to_datetime(date_strings(pd.Series(unique_dates, dtype=object)), errors='coerce', format=date_format)
+        data['date'] = parsed.reindex(codes).to_numpy() # (code -1 = missing date -> NaT)
+    data['description'] = data['description'].fillna("").astype(str).str.strip()
+    data['amount'] = clean_amounts(data['amount'])
+    return data.dropna(subset=['date', 'amount']).reset_index(drop=True)
+
+def monopoly_records(transactions):
+    """Flattens monopoly's transaction objects into plain date/description/amount records."""
+    records = []
+    for transaction in transactions:
+        if hasattr(transaction, 'as_raw_dict'):
+            record = transaction.as_raw_dict()
+        else:
+            record = vars(transaction)
+        records.append({
+            'date': record.get('date', record.get('transaction_date')),
+            'description': record.get('description'),
+            'amount': record.get('amount')
+        })
+    return records
+
+def read_pdf_statement_in_memory(file):
+    """
+    Runs monopoly as a library straight on the uploaded bytes:
+    no temp folder, no CSV written to disk and read back.
+    Raises ValueError if monopoly can't read this statement (the CLI couldn't either).
+    """
+    # Imported here so a monopoly without this API only costs us the fast path
+    from monopoly.banks import BankDetector, banks
+    from monopoly.generic import GenericBank
+    from monopoly.pdf import BadPasswordFormatError, MissingPasswordError, PdfDocument, PdfParser, WrongPasswordError
+    from monopoly.pipeline import Pipeline
+    from monopoly.statements import ExtractionError, SafetyCheckError
+
+    try:
+        document = PdfDocument(file_bytes=file.getvalue())
+        document.unlock_document()
+        bank = BankDetector(document).detect_bank(banks) or GenericBank
+        pipeline = Pipeline(PdfParser(bank, document))
+        # Keep the safety check on (like the CLI's default): a statement whose
+        # transactions don't add up to its total is skipped, not half-imported
+        statement = pipeline.extract(safety_check=True)
+        transactions = pipeline.transform(statement)
+    except SafetyCheckError as e:
+        raise ValueError(f"its transactions don't add up to the statement total ({e})") from e
+    except (MissingPasswordError, WrongPasswordError, BadPasswordFormatError) as e:
+        raise ValueError(f"the PDF is locked ({e})") from e
+    except (ExtractionError, ValueError, RuntimeError) as e:
+        raise ValueError(f"monopoly couldn't read it ({type(e).__name__}: {e})") from e
+
+    records = monopoly_records(transactions)
+    if not records:
+        return None
+    return pd.DataFrame.from_records(records, columns=STATEMENT_COLUMNS)
+
+def read_pdf_statement_via_cli(file):
+    """The fallback path: hand the PDF to the monopoly CLI and read back the CSV it writes."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir_path = Path(temp_dir)
+        input_pdf_path = temp_dir_path / file.name
+        input_pdf_path.write_bytes(file.getvalue())
+
+        command = ["monopoly", str(input_pdf_path), "-o", str(temp_dir_path)]
+        subprocess.run(command, check=True, capture_output=True, text=True)
+
+        csv_files = list(temp_dir_path.glob("*.csv"))
+        if not csv_files:
+            return None
+        return pd.read_csv(csv_files[0])
+
+# What makes us fall back to the CLI: an API that doesn't match the installed
+# monopoly. A PDF monopoly can't read is a ValueError instead, and that file is
+# skipped (the CLI runs the same pipeline, so it would only fail more slowly).
+PDF_FALLBACK_ERRORS = (ImportError, AttributeError, TypeError)
+
+def warn_pdf_fallback(file, error):
+    """Logs every fallback, and tells the user (once per session) that PDFs are taking the slow path."""
+    logging.getLogger(__name__).warning("In-memory PDF parsing failed for %s, using the monopoly CLI: %r", file.name, error)
+    if not st.session_state.pdf_fallback_warned:
+        st.session_state.pdf_fallback_warned = True
+        st.warning(f"Couldn't read `{file.name}` in memory ({type(error).__name__}: {error}), so PDFs are going through the slower monopoly CLI.")
+
+def read_pdf_statement(file):
+    """
+    Parses a PDF in memory if we can, otherwise falls back to the CLI + temp folder.
+    Raises ValueError for a statement monopoly can't read.
+    """
+    try:
+        return read_pdf_statement_in_memory(file)
+    except PDF_FALLBACK_ERRORS as e:
+        warn_pdf_fallback(file, e)
+        return read_pdf_statement_via_cli(file)
+
+def read_csv_statement(file, column_mapping=None, flip_sign=False, date_order=None):
+    """
+    Reads a bank's CSV export. column_mapping is {'date': ..., 'description': ..., 'amount': ...}
+    with the CSV's own header names; anything left blank is guessed from CSV_COLUMN_GUESSES.
+    Only the three columns we need are parsed, CSV_CHUNK_ROWS rows at a time.
+    date_order ('day', 'month' or None to detect) applies to the whole file.
+    """
+    column_mapping = column_mapping or {}
+    file.seek(0)
+    header = pd.read_csv(file, nrows=0).columns
+    file.seek(0)
+    lower_header = {str(column).strip().lower(): column for column in header}
+
+    source_columns = {}
+    for target, guesses in CSV_COLUMN_GUESSES.items():
+        wanted = (column_mapping.get(target) or "").strip()
+        if wanted:
+            if wanted.lower() not in lower_header:
+                raise ValueError(f"column '{wanted}' (mapped to '{target}') is not in the CSV")
+            source_columns[target] = lower_header[wanted.lower()]
+        else:
+            found = next((lower_header[guess] for guess in guesses if guess in lower_header), None)
+            if found is None:
+                raise ValueError(f"couldn't find a '{target}' column - set it under 'CSV Import Settings'")
+            source_columns[target] = found
+
+    # One date format for the whole file (worked out from the date column alone), not per chunk
+    date_format = infer_date_format(pd.read_csv(file, usecols=[source_columns['date']], dtype=str)[source_columns['date']], date_order)
+    file.seek(0)
+
+    rename_map = {source: target for target, source in source_columns.items()}
+    chunks = pd.read_csv(
+        file,
+        usecols=list(source_columns.values()),
+        dtype={source_columns['description']: str},
+        chunksize=CSV_CHUNK_ROWS
+    )
+    tidy_chunks = [tidy_statement_frame(chunk.rename(columns=rename_map), date_format) for chunk in chunks]
+    if not tidy_chunks:
+        return pd.DataFrame(columns=STATEMENT_COLUMNS)
+
+    data = pd.concat(tidy_chunks, ignore_index=True)
+    if flip_sign:
+        # Some banks export spending as positive numbers; we store it as negative
+        data['amount'] = data['amount'] * -1
+    return data
+
+def iter_text_lines(file):
+    """Yields the lines of an uploaded text file one at a time (no full decoded copy)."""
+    file.seek(0)
+    text_stream = TextIOWrapper(file, encoding='utf-8', errors='replace')
+    try:
+        for line in text_stream:
+            yield line.rstrip('\r\n')
+    finally:
+        # Don't let the wrapper close the uploaded file when it's garbage collected
+        text_stream.detach()
+
+# One match per tag: '/' if it's a closing tag, the tag name, and the text after it
+OFX_TAG_PATTERN = re.compile(r'<(/?)(\w+)>([^<]*)')
+
+def read_ofx_statement(file):
+    """
+    Reads an OFX/QFX download (both the old SGML flavour and the XML one).
+    We walk the tags themselves, not the lines, so a file written on one line works too.
+    """
+    records = []
+    current = None
+    for line in iter_text_lines(file):
+        for closing, tag, value in OFX_TAG_PATTERN.findall(line):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and current is not None:
+                    records.append(current)
+                current = None if closing else {}
+            elif current is not None and not closing:
+                current[tag] = html.unescape(value.strip())
+
+    data = pd.DataFrame.from_records(records, columns=['DTPOSTED', 'TRNAMT', 'NAME', 'MEMO'])
+    data = pd.DataFrame({
+        # DTPOSTED looks like 20250131120000[-5:EST]; the first 8 digits are the date
+        'date': pd.to_datetime(data['DTPOSTED'].str[:8], format='%Y%m%d', errors='coerce'),
+        'description': data['NAME'].where(data['NAME'].fillna("") != "", data['MEMO']),
+        'amount': data['TRNAMT']
+    })
+    return tidy_statement_frame(data)
+
+def read_qif_statement(file):
+    """Reads a Quicken QIF file (D = date, T/U = amount, P = payee, M = memo, ^ = end of record)."""
+    records = []
+    current = {}
+    for line in iter_text_lines(file):
+        code, value = line[:1], line[1:].strip()
+        if code == '^':
+            if current:
+                records.append(current)
+            current = {}
+        elif code in ('D', 'T', 'U', 'P', 'M'):
+            current.setdefault(code, value) # 'T' and 'U' repeat the amount; keep the first
+    if current:
+        records.append(current)
+
+    data = pd.DataFrame.from_records(records, columns=['D', 'T', 'U', 'P', 'M'])
+    data = pd.DataFrame({
+        # Quicken writes years like 1/31'25, so turn the apostrophe into a slash
+        'date': data['D'].str.replace(r"'\s*", "/", regex=True).str.replace(" ", ""),
+        'description': data['P'].where(data['P'].fillna("") != "", data['M']),
+        'amount': data['T'].fillna(data['U'])
+    })
+    # QIF dates are month-first (M/D/YY or M/D/YYYY); only the year's width is worked out
+    return tidy_statement_frame(data, infer_date_format(data['date'], date_order='month'))
+
+def parse_statement(file, csv_mapping=None):
+    """
+    Turns one uploaded statement into a date/description/amount frame.
+    Only PDFs go through monopoly; CSV/OFX/QIF are read directly.
+    Returns None if nothing could be read. Raises ValueError for unreadable files.
+    """
+    statement_format = detect_statement_format(file)
+    csv_mapping = csv_mapping or {}
+
+    if statement_format == 'pdf':
+        data = read_pdf_statement(file)
+        # monopoly always hands back ISO dates (YYYY-MM-DD)
+        return None if data is None else tidy_statement_frame(data, 'ISO8601')
+
+    try:
+        if statement_format == 'ofx':
+            return read_ofx_statement(file)
+        if statement_format == 'qif':
+            return read_qif_statement(file)
+        return read_csv_statement(
+            file,
+            column_mapping=csv_mapping.get('columns'),
+            flip_sign=csv_mapping.get('flip_sign', False),
+            date_order=csv_mapping.get('date_order')
+        )
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise ValueError(str(e)) from e
+
+# --- STAGING AREA (finished files wait on disk, not in memory) ---
+# Every processed statement is written to Parquet "pages" of at most
+# STAGING_PAGE_ROWS rows in a temp folder as soon as it's done. The editor shows
+# and saves ONE page at a time, so a batch of hundreds of statements never has
+# to sit in memory (or in session state) all at once. Only building the Excel
+# file reads the whole batch, and just for as long as that takes.
+STAGING_PAGE_ROWS = 5_000
+STAGING_PREFIX = "finance-tracker-staging-"
+STAGING_MAX_IDLE_HOURS = 12 # Staging folders nobody has touched for this long belonged to a session that ended
+STAGING_COLUMNS = ['date', 'description', 'amount', 'merchant', 'Category']
+
+def staging_schema():
+    """The one schema every staged page is written with (so pages always read back alike)."""
+    import pyarrow as pa
+    return pa.schema([
+        ('date', pa.timestamp('ns')),
+        ('description', pa.string()),
+        ('amount', pa.float64()),
+        ('merchant', pa.string()),
+        ('Category', pa.string())
+    ])
+
+def start_staging_area(old_staging_dir=None):
+    """Makes a fresh, empty staging folder (and throws away the old one)."""
+    clear_staging_area(old_staging_dir)
+    clear_abandoned_staging_areas()
+    return tempfile.mkdtemp(prefix=STAGING_PREFIX)
+
+def clear_staging_area(staging_dir):
+    """Deletes a staging folder and everything in it."""
+    if staging_dir:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def touch_staging_area(staging_dir):
+    """Marks a staging folder as still in use (so clear_abandoned_staging_areas leaves it alone)."""
+    if staging_dir:
+        try:
+            os.utime(staging_dir)
+        except OSError:
+            pass # Already gone
+
+def clear_abandoned_staging_areas():
+    """
+    Deletes the staging folders of sessions that ended without cleaning up
+    (closed tabs, expired sessions): any folder untouched for STAGING_MAX_IDLE_HOURS.
+    Live sessions touch their folder on every rerun.
+    """
+    cutoff = time.time() - STAGING_MAX_IDLE_HOURS * 3600
+    for staging_dir in Path(tempfile.gettempdir()).glob(f"{STAGING_PREFIX}*"):
+        try:
+            if staging_dir.stat().st_mtime < cutoff:
+                clear_staging_area(staging_dir)
+        except OSError:
+            pass # Another session got there first
+
+def write_staged_page(page_path, data):
+    """
+    Writes one page. Whole-number amounts become floats, text stays text, etc.,
+    and the pandas dtype notes are left out, so a CSV with "-10" and one with
+    "-10.50" can sit side by side.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    data = data.reindex(columns=STAGING_COLUMNS)
+    data['date'] = pd.to_datetime(data['date'])
+    data['amount'] = pd.to_numeric(data['amount'], errors='coerce')
+    table = pa.Table.from_pandas(data, schema=staging_schema(), preserve_index=False)
+    pq.write_table(table.replace_schema_metadata(None), page_path)
+
+def stage_file_result(staging_dir, file_index, data):
+    """Spills one finished statement to the staging folder, STAGING_PAGE_ROWS rows per page."""
+    for page_number, page_start in enumerate(range(0, len(data), STAGING_PAGE_ROWS)):
+        # Zero-padded names keep the pages in upload order when they're read back
+        page_path = Path(staging_dir) / f"part-{file_index:05d}-{page_number:04d}.parquet"
+        write_staged_page(page_path, data.iloc[page_start:page_start + STAGING_PAGE_ROWS])
+
+def list_staged_pages(staging_dir):
+    """The staged pages, in upload order."""
+    if not staging_dir:
+        return []
+    return sorted(Path(staging_dir).glob("part-*.parquet"))
+
+def read_staged_page(page_path):
+    """Reads one page back (for the editor)."""
+    return pd.read_parquet(page_path)
+
+def read_staging_area(staging_dir):
+    """Reads every staged page back as one frame (or None if nothing was staged)."""
+    pages = list_staged_pages(staging_dir)
+    if not pages:
+        return None
+    return pd.concat([read_staged_page(page_path) for page_path in pages], ignore_index=True)
+
+def process_files_to_staging(uploaded_files, staging_dir, csv_mapping=None, merchant_rules=None, known_labels=None):
+    """
+    The no-AI path: parses each file, gives it merchants and categories
+    ("None", or the known label for recurring merchants) and stages it straight away.
+    Returns how many transactions were staged.
+    """
+    known_labels = known_labels or {}
+    staged_rows = 0
+    for file_index, file in enumerate(uploaded_files):
+        try:
+            data = parse_statement(file, csv_mapping)
+        except ValueError as e:
+            st.warning(f"Could not read `{file.name}`: {e}. Skipping it.")
+            continue
+        if data is None or data.empty:
+            continue
+
+        data = data[STATEMENT_COLUMNS].copy()
+        data['merchant'] = normalize_merchants(data['description'], merchant_rules)
+        data['Category'] = data['merchant'].map(known_labels).fillna("None")
+        stage_file_result(staging_dir, file_index, data)
+        staged_rows += len(data)
+    return staged_rows
+
+# --- MERCHANT NORMALIZATION ---
+# Turns raw descriptions like "SQ *STARBUCKS 0987" or "STARBUCKS #1234 SEATTLE WA"
+# into one clean 'merchant' name ("STARBUCKS"). The rules only run ONCE per
+# distinct description, and then get spread back over all the rows.
+US_STATE_CODES = (
+    "AL|AK|AZ|AR|CA|CO|CT|DE|DC|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MD|MA|MI|MN|MS|MO|"
+    "MT|NE|NV|NH|NJ|NM|NY|NC|ND|OH|OK|OR|PA|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY"
+)
+
+# (what it strips, compiled pattern, replacement) - applied in this order
+MERCHANT_RULES = [
+    ("Payment processor / card prefixes", re.compile(
+        r"^(?:SQ\s?\*|SQU\*|TST\s?\*|PAYPAL\s?\*|PP\s?\*|SP\s?\*|GOOGLE\s?\*|"
+        r"AMZN\s+MKTP\s+[A-Z]{2}\s?\*?|POS\s+(?:PURCHASE\s+)?|DEBIT\s+CARD\s+PURCHASE\s+|"
+        r"PURCHASE\s+AUTHORIZED\s+ON\s+\d{1,2}/\d{1,2}\s+|CHECKCARD\s+\d{4}\s+|"
+        r"VISA\s+DDA\s+PUR\s+|RECURRING\s+PAYMENT\s+)+"
+    ), ""),
+    ("Codes after a '*'", re.compile(r"\*\s*[A-Z0-9]*\d[A-Z0-9]*"), " "),
+    ("Dates", re.compile(r"\b\d{1,2}/\d{1,2}(?:/\d{2,4})?\b"), " "),
+    ("Store numbers", re.compile(r"(?:#|\bNO\.|\bSTORE\s+)\s*\d+\b"), " "),
+    ("Reference IDs", re.compile(r"\b[A-Z]*\d{4,}[A-Z0-9]*\b|\b\d{3,}\b"), " "),
+    ("Locations (City ST / country)", re.compile(
+        r"\s+(?:(?:SAN|SANTA|LOS|LAS|NEW|FORT|FT|ST|SAINT|EL|PALO|SALT\s+LAKE|WEST|EAST|NORTH|SOUTH)\s+)?"
+        r"[A-Z]{3,}\s+(?:" + US_STATE_CODES + r")(?:\s+(?:US|USA))?\s*$|\s+(?:US|USA)\s*$"
+    ), ""),
+    ("Leftover punctuation", re.compile(r"[^A-Z0-9&'.\- ]+"), " "),
+    ("Trailing store numbers", re.compile(r"(?:\s+\d{1,4})+\s*$"), "")
+]
+
+def parse_merchant_rules(rules_text):
+    """
+    Reads the user's own merchant rules, one per line: "pattern => Merchant Name".
+    The pattern is a (case-insensitive) regular expression matched anywhere in the description.
+    Returns the compiled rules plus a list of lines we couldn't understand.
+    """
+    rules = []
+    problems = []
+    for line in rules_text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        pattern, arrow, merchant_name = line.partition("=>")
+        if not arrow or not pattern.strip() or not merchant_name.strip():
+            problems.append(f"`{line}` (expected `pattern => Merchant Name`)")
+            continue
+        try:
+            rules.append((re.compile(pattern.strip(), re.IGNORECASE), merchant_name.strip()))
+        except re.error as e:
+            problems.append(f"`{line}` ({e})")
+    return rules, problems
+
+def normalize_merchants(descriptions, user_rules=None):
+    """
+    Returns the clean merchant name for every description (same index).
+    User rules win over the built-in ones (and the first matching user rule wins).
+    """
+    codes, unique_descriptions = pd.factorize(descriptions.fillna("").astype(str))
+    raw = pd.Series(unique_descriptions, dtype=object).str.upper().str.split().str.join(" ")
+
+    merchants = raw
+    for _, pattern, replacement in MERCHANT_RULES:
+        merchants = merchants.str.replace(pattern, replacement, regex=True)
+    merchants = merchants.str.split().str.join(" ").str.strip(" .-&'")
+    # If we stripped *everything*, fall back to the tidied-up description
+    merchants = merchants.where(merchants != "", raw)
+
+    for pattern, merchant_name in reversed(user_rules or []):
+        merchants = merchants.mask(raw.str.contains(pattern), merchant_name)
+
+    return pd.Series(merchants.to_numpy()[codes], index=descriptions.index, dtype=object)
+
+# Only these rules are used to match a PDF row with its CSV/OFX twin: the
+# processor prefix and the location are what the formats disagree on, while
+# store numbers, check numbers and reference IDs tell real transactions apart.
+CROSS_FORMAT_RULES = ["Payment processor / card prefixes", "Locations (City ST / country)"]
+
+def duplicate_keys(df, match_across_formats=False):
+    """
+    The DUPLICATE_KEY columns of df, ready for .duplicated(). With match_across_formats
+    the descriptions lose just their processor prefix and location first, so
+    "SQ *STARBUCKS #12 SEATTLE WA" and "STARBUCKS #12" count as the same transaction.
+    """
+    # Like the merchants: the rules run once per distinct description
+    codes, unique_descriptions = pd.factorize(df['description'].fillna("").astype(str))
+    descriptions = pd.Series(unique_descriptions, dtype=object)
+    if match_across_formats:
+        descriptions = descriptions.str.upper().str.split().str.join(" ")
+        for name, pattern, replacement in MERCHANT_RULES:
+            if name in CROSS_FORMAT_RULES:
+                descriptions = descriptions.str.replace(pattern, replacement, regex=True)
+        descriptions = descriptions.str.split().str.join(" ")
+    return pd.DataFrame({
+        'date': df['date'],
+        'description': descriptions.to_numpy()[codes],
+        'amount': df['amount']
+    }, index=df.index)
+
+def fill_missing_merchants(df, user_rules=None):
+    """Adds/fills the 'merchant' column (e.g. for masters saved before we had one)."""
+    if 'merchant' not in df.columns:
+        df['merchant'] = normalize_merchants(df['description'], user_rules)
+        return df
+    missing = df['merchant'].isna() | (df['merchant'].astype(str).str.strip() == "")
+    if missing.any():
+        df.loc[missing, 'merchant'] = normalize_merchants(df.loc[missing, 'description'], user_rules)
+    return df
+
+# --- RECURRING CHARGES (Subscriptions detector) ---
+# A merchant is "recurring" when its charges come at a steady rhythm (weekly,
+# monthly or yearly) for a steady-ish amount. Everything below works on NumPy
+# arrays sorted by (merchant, date), so it's one pass over the whole history.
+RECURRENCE_RULES = [
+    # (name, typical gap in days, lowest and highest median gap, gap tolerance, fewest charges)
+    ('Weekly', 7, 6, 8, 2, 4),
+    ('Monthly', 30.44, 26, 35, 5, 3),
+    ('Yearly', 365.25, 350, 380, 15, 2)
+]
+RECURRING_MIN_REGULARITY = 0.75 # Share of gaps that must match the rhythm
+RECURRING_MAX_AMOUNT_SPREAD = 0.20 # Max std / mean of the amounts
+RECURRING_COLUMNS = ['Merchant', 'Frequency', 'Typical Amount', 'Charges', 'Last Charge', 'Next Expected', 'Category', 'Active']
+
+def detect_recurring_charges(all_data):
+    """
+    Finds the merchants that charge on a regular schedule (needs 'date', 'merchant',
+    'amount' and 'Category'). Returns one row per recurring merchant, with the
+    next date we expect to see it.
+    """
+    spending = all_data[all_data['amount'] < 0]
+    if spending.empty:
+        return pd.DataFrame(columns=RECURRING_COLUMNS)
+
+    merchant_codes, merchants = pd.factorize(spending['merchant'].astype(str))
+    days = spending['date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+    amounts = -spending['amount'].to_numpy(dtype=float)
+    order = np.lexsort((days, merchant_codes))
+    merchant_codes, days, amounts = merchant_codes[order], days[order], amounts[order]
+    num_merchants = len(merchants)
+
+    # --- 1. Gaps between consecutive charges at the same merchant ---
+    same_merchant = merchant_codes[1:] == merchant_codes[:-1]
+    gaps = np.diff(days)
+    gap_codes = merchant_codes[1:]
+    keep = same_merchant & (gaps > 0) # Two charges on the same day aren't a rhythm
+    gaps, gap_codes = gaps[keep], gap_codes[keep]
+    if len(gaps) == 0:
+        return pd.DataFrame(columns=RECURRING_COLUMNS)
+
+    gap_stats = pd.DataFrame({'code': gap_codes, 'gap': gaps}).groupby('code')['gap'].median()
+    median_gap = np.full(num_merchants, np.nan)
+    median_gap[gap_stats.index.to_numpy()] = gap_stats.to_numpy()
+
+    # --- 2. Which rhythm (if any) does each merchant's median gap fit? ---
+    rhythm = np.full(num_merchants, -1)
+    for rule_index, (_, _, low, high, _, _) in enumerate(RECURRENCE_RULES):
+        rhythm[(median_gap >= low) & (median_gap <= high)] = rule_index
+    periods = np.array([rule[1] for rule in RECURRENCE_RULES])
+    tolerances = np.array([rule[4] for rule in RECURRENCE_RULES])
+    min_charges = np.array([rule[5] for rule in RECURRENCE_RULES])
+
+    # --- 3. How regular is it? (share of gaps within tolerance of the rhythm) ---
+    gap_rhythm = rhythm[gap_codes]
+    has_rhythm = gap_rhythm >= 0
+    on_beat = np.zeros(len(gaps), dtype=bool)
+    on_beat[has_rhythm] = np.abs(gaps[has_rhythm] - periods[gap_rhythm[has_rhythm]]) <= tolerances[gap_rhythm[has_rhythm]]
+    regularity = np.bincount(gap_codes, weights=on_beat, minlength=num_merchants) / np.maximum(
+        np.bincount(gap_codes, minlength=num_merchants), 1
+    )
+
+    # --- 4. How steady is the amount? ---
+    charges = np.bincount(merchant_codes, minlength=num_merchants)
+    amount_sum = np.bincount(merchant_codes, weights=amounts, minlength=num_merchants)
+    amount_sq_sum = np.bincount(merchant_codes, weights=amounts ** 2, minlength=num_merchants)
+    amount_mean = amount_sum / np.maximum(charges, 1)
+    amount_std = np.sqrt(np.maximum(amount_sq_sum / np.maximum(charges, 1) - amount_mean ** 2, 0))
+    amount_spread = amount_std / np.where(amount_mean > 0, amount_mean, np.inf)
+
+    is_recurring = (
+        (rhythm >= 0)
+        & (charges >= np.where(rhythm >= 0, min_charges[rhythm], np.inf))
+        & (regularity >= RECURRING_MIN_REGULARITY)
+        & (amount_spread <= RECURRING_MAX_AMOUNT_SPREAD)
+    )
+    recurring_codes = np.flatnonzero(is_recurring)
+    if len(recurring_codes) == 0:
+        return pd.DataFrame(columns=RECURRING_COLUMNS)
+
+    # --- 5. Describe each recurring merchant ---
+    last_index = np.flatnonzero(np.r_[merchant_codes[1:] != merchant_codes[:-1], True]) # Last row of each merchant
+    last_day = np.empty(num_merchants, dtype=np.int64)
+    last_day[merchant_codes[last_index]] = days[last_index]
+    # The category each recurring merchant usually had (ignoring "None")
+    row_categories = spending['Category'].to_numpy()[order]
+    labelled = is_recurring[merchant_codes] & (row_categories != "None")
+    usual_category = (
+        pd.DataFrame({'code': merchant_codes[labelled], 'Category': row_categories[labelled]})
+        .value_counts().reset_index().drop_duplicates('code').set_index('code')['Category']
+    )
+
+    last_charge = pd.to_datetime(last_day[recurring_codes], unit='D')
+    period_days = periods[rhythm[recurring_codes]]
+    next_expected = last_charge + pd.to_timedelta(np.round(period_days), unit='D')
+    latest_day = pd.Timestamp(days.max(), unit='D')
+    recurring = pd.DataFrame({
+        'Merchant': merchants[recurring_codes],
+        'Frequency': [RECURRENCE_RULES[rule_index][0] for rule_index in rhythm[recurring_codes]],
+        'Typical Amount': np.round(amount_mean[recurring_codes], 2),
+        'Charges': charges[recurring_codes],
+        'Last Charge': last_charge,
+        'Next Expected': next_expected,
+        'Category': usual_category.reindex(recurring_codes).fillna("None").to_numpy(),
+        # Still going if we haven't missed a charge (give or take the tolerance)
+        'Active': (next_expected + pd.to_timedelta(tolerances[rhythm[recurring_codes]], unit='D')) >= latest_day
+    })
+    return recurring.sort_values(['Active', 'Typical Amount'], ascending=[False, False], ignore_index=True)
+
+def recurring_merchant_labels(recurring, categories_list):
+    """
+    Picks a category for every recurring merchant, so those rows can skip the AI:
+    the category it usually had before, or "Subscriptions" if it never had one.
+    """
+    labels = {}
+    for merchant, category in zip(recurring['Merchant'], recurring['Category']):
+        if category in categories_list and category != "None":
+            labels[merchant] = category
+        elif "Subscriptions" in categories_list:
+            labels[merchant] = "Subscriptions"
+    return labels
+
+# --- ROLLUP "CUBE" (Month x Category) ---
+# One small table with a row per (Month, Category) holding the summed amount,
+# the transaction count and the date span. The dashboard's charts are drawn
+# from it instead of from every single transaction.
+ROLLUP_COLUMNS = ['Month', 'Category', 'amount', 'count', 'first_date', 'last_date']
+
+def build_rollup(df):
+    """
+    Collapses a frame of transactions (date, amount, Category)
+    into the Month x Category rollup.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+
+    months = df['date'].dt.to_period('M').dt.to_timestamp().rename('Month')
+    rollup = df.groupby([months, df['Category']]).agg(
+        amount=('amount', 'sum'),
+        count=('amount', 'size'),
+        first_date=('date', 'min'),
+        last_date=('date', 'max')
+    ).reset_index()
+    return rollup[ROLLUP_COLUMNS]
+
+# --- MULTI-GRANULARITY ROLLUPS (Daily / Weekly / Monthly / Quarterly / Yearly) ---
+# Every granularity is folded up from the same Day x Category grain, so the raw
+# transactions are only grouped ONCE no matter how many Overview sheets we write.
+PERIOD_GRANULARITIES = {
+    # name: Overview sheet, pandas period (weeks are ISO: Monday to Sunday), chart frequency, index name
+    'Daily': {'sheet': 'Daily Overview', 'period': 'D', 'freq': 'D', 'index': 'Day'},
+    'Weekly': {'sheet': 'Weekly Overview', 'period': 'W-SUN', 'freq': 'W-MON', 'index': 'Week'},
+    'Monthly': {'sheet': 'Monthly Overview', 'period': 'M', 'freq': 'MS', 'index': 'Month'},
+    'Quarterly': {'sheet': 'Quarterly Overview', 'period': 'Q', 'freq': 'QS', 'index': 'Quarter'},
+    'Yearly': {'sheet': 'Yearly Overview', 'period': 'Y', 'freq': 'YS', 'index': 'Year'}
+}
+
+def build_period_pivots(df, granularities=tuple(PERIOD_GRANULARITIES)):
+    """
+    Builds the "Actual" spend pivot (Period rows x Category columns) for each
+    requested granularity. Rows are indexed by the period's start date.
+    """
+    # The one pass over the transactions: down to the daily grain
+    days = df['date'].dt.normalize()
+    daily = df.groupby([days, df['Category']])['amount'].sum().unstack('Category', fill_value=0) * -1 # Invert values
+
+    pivots = {}
+    for name in granularities:
+        settings = PERIOD_GRANULARITIES[name]
+        if name == 'Daily':
+            pivot = daily.copy()
+        else:
+            # Fold the (small) daily table up to the coarser periods
+            period_starts = daily.index.to_period(settings['period']).to_timestamp(how='start')
+            pivot = daily.groupby(period_starts).sum()
+        pivot.index.name = settings['index']
+        pivots[name] = pivot
+    return pivots
+
+def format_period_labels(period_starts, granularity):
+    """Turns period start dates into the "pretty" labels we show in the Overview sheets."""
+    if granularity == 'Daily':
+        return period_starts.strftime('%d %b %Y')
+    if granularity == 'Weekly':
+        iso = period_starts.isocalendar()
+        labels = [f"{year}-W{week:02d}" for year, week in zip(iso['year'], iso['week'])]
+        return pd.Index(labels, name=period_starts.name)
+    if granularity == 'Quarterly':
+        labels = [f"Q{quarter} {year}" for quarter, year in zip(period_starts.quarter, period_starts.year)]
+        return pd.Index(labels, name=period_starts.name)
+    if granularity == 'Yearly':
+        return period_starts.strftime('%Y')
+    return period_starts.strftime('%B %Y')
+
+# --- DASHBOARD DATA LOADING & LEDGER INDEX ---
+def read_expenses_sheet(xls):
+    """Reads the 'Expenses' sheet and cleans it up for the dashboard."""
+    all_data = pd.read_excel(xls, sheet_name="Expenses")
+
+    # FIX: The Dashboard crashes if categories are NaN/Blank.
+    # We force ALL categories to be strings. If they are NaN, they become "None".
+    all_data['Category'] = all_data['Category'].fillna("None").astype(str)
+    all_data['Category'] = all_data['Category'].replace("", "None")
+
+    # Ensure 'amount' is numeric, just in case
+    all_data['amount'] = pd.to_numeric(all_data['amount'], errors='coerce')
+    all_data.dropna(subset=['amount'], inplace=True)
+
+    # Ensure 'date' is datetime
+    all_data['date'] = pd.to_datetime(all_data['date'])
+
+    # Masters saved before we had merchants get them now
+    return fill_missing_merchants(all_data)
+
+
+def build_ledger_index(all_data):
+    """
+    Sorts the ledger by date ONCE and builds the lookups our filters use:
+    - 'dates': the sorted dates as a NumPy array (for searchsorted)
+    - 'category_rows': the (sorted) row positions of every category
+    """
+    ledger = all_data.sort_values('date', kind='stable', ignore_index=True)
+    return {
+        'ledger': ledger,
+        'dates': ledger['date'].to_numpy(dtype='datetime64[ns]'),
+        'category_rows': ledger.groupby('Category').indices
+    }
+
+# cache_resource (not cache_data) so we share one index instead of copying the ledger every rerun
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_ledger_index(file_bytes):
+    """Reads the 'Expenses' sheet of a master file and indexes it (once per file)."""
+    with pd.ExcelFile(BytesIO(file_bytes), engine='openpyxl') as xls:
+        return build_ledger_index(read_expenses_sheet(xls))
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_dashboard_rollup(file_bytes):
+    """
+    Gets the Month x Category rollup for a master file. It's rolled up from the
+    same ledger the filters and drill-downs use, so all the views agree.
+    """
+    return build_rollup(load_ledger_index(file_bytes)['ledger'])
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_recurring_charges(file_bytes):
+    """Runs the recurring-charge detector over a master file's whole history (once per file)."""
+    return detect_recurring_charges(load_ledger_index(file_bytes)['ledger'])
+
+def recurring_labels_from_master(categories_list):
+    """The recurring-merchant labels from the uploaded master (empty if there's no usable master)."""
+    if st.session_state.uploaded_master_file is None:
+        return {}
+    try:
+        recurring = load_recurring_charges(st.session_state.uploaded_master_file.getvalue())
+    except Exception:
+        return {} # A bad master file shouldn't stop us from processing statements
+    return recurring_merchant_labels(recurring, categories_list)
+
+def filter_ledger(ledger_index, start_date, end_date, categories=None):
+    """
+    Returns the transactions between start_date and end_date (both inclusive),
+    optionally limited to some categories. No full scan: the date range is two
+    binary searches, and each category's rows are cut down to that range the same way.
+    """
+    dates = ledger_index['dates']
+    lo = dates.searchsorted(pd.Timestamp(start_date).to_datetime64(), side='left')
+    hi = dates.searchsorted((pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_datetime64(), side='left')
+
+    if not categories:
+        return ledger_index['ledger'].iloc[lo:hi]
+
+    picked_rows = []
+    for category in categories:
+        rows = ledger_index['category_rows'].get(category)
+        if rows is not None:
+            picked_rows.append(rows[rows.searchsorted(lo):rows.searchsorted(hi)])
+
+    if not picked_rows:
+        return ledger_index['ledger'].iloc[0:0]
+    return ledger_index['ledger'].iloc[np.sort(np.concatenate(picked_rows))]
+
+# --- SQL LEDGER (SQLite, for ad-hoc questions) ---
+# Each master file gets its own SQLite copy of the 'Expenses' sheet, named after
+# a hash of the file. It's built once, then reused on every rerun (and the next
+# time the same file is uploaded). When we build a merged master we copy the old
+# database and apply just the new rows, so the merged file's database is ready too.
+LEDGER_DB_DIR = Path(tempfile.gettempdir()) / "finance-tracker-sql"
+LEDGER_DB_KEEP = 10 # Only the newest few databases are kept around
+SQL_MAX_ROWS = 5_000 # Don't try to show more rows than this in the app
+SQL_TIMEOUT_SECONDS = 10 # A runaway query (endless recursive CTE, huge cross join) is stopped after this
+
+LEDGER_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    date        TEXT NOT NULL,  -- 'YYYY-MM-DD'
+    month       TEXT NOT NULL,  -- 'YYYY-MM'
+    description TEXT,
+    merchant    TEXT,           -- description with the noise stripped off
+    amount      REAL,           -- negative = money spent
+    category    TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date);
+CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses(category, date);
+CREATE INDEX IF NOT EXISTS idx_expenses_merchant ON expenses(merchant, date);
+"""
+
+SAVED_SQL_QUERIES = {
+    "Top merchants": """
+SELECT merchant, COUNT(*) AS transactions, ROUND(-SUM(amount), 2) AS spent
+FROM expenses
+GROUP BY merchant
+ORDER BY spent DESC
+LIMIT 25""",
+    "Month-over-month change": """
+WITH monthly AS (
+    SELECT month, -SUM(amount) AS spent FROM expenses GROUP BY month
+)
+SELECT month,
+       ROUND(spent, 2) AS spent,
+       ROUND(spent - LAG(spent) OVER (ORDER BY month), 2) AS change,
+       ROUND(100.0 * (spent - LAG(spent) OVER (ORDER BY month))
+             / NULLIF(LAG(spent) OVER (ORDER BY month), 0), 1) AS change_pct
+FROM monthly
+ORDER BY month""",
+    "Per-category trend (monthly)": """
+SELECT month, category, ROUND(-SUM(amount), 2) AS spent, COUNT(*) AS transactions
+FROM expenses
+GROUP BY month, category
+ORDER BY month, spent DESC""",
+    "Biggest transactions": """
+SELECT date, description, category, ROUND(-amount, 2) AS spent
+FROM expenses
+ORDER BY amount ASC
+LIMIT 25"""
+}
+
+def ledger_db_path(file_bytes):
+    """Where the SQLite copy of a master file lives."""
+    return LEDGER_DB_DIR / f"ledger-{hashlib.sha256(file_bytes).hexdigest()[:20]}.sqlite"
+
+def ledger_sql_rows(all_data):
+    """Shapes transactions into rows for the 'expenses' table."""
+    merchants = all_data['merchant'] if 'merchant' in all_data.columns else normalize_merchants(all_data['description'])
+    return pd.DataFrame({
+        'date': all_data['date'].dt.strftime('%Y-%m-%d'),
+        'month': all_data['date'].dt.strftime('%Y-%m'),
+        'description': all_data['description'],
+        'merchant': merchants,
+        'amount': all_data['amount'],
+        'category': all_data['Category']
+    })
+
+def write_ledger_db(db_path, all_data=None, base_db_path=None):
+    """
+    Writes a ledger database: starts from a copy of base_db_path (or an empty one),
+    then adds all_data. Rows already in the database with the same date, description
+    and amount are replaced, just like the de-duplication in the "Master Chef".
+    """
+    LEDGER_DB_DIR.mkdir(parents=True, exist_ok=True)
+    temp_path = db_path.with_suffix(".tmp")
+    if base_db_path is not None:
+        shutil.copyfile(base_db_path, temp_path)
+    else:
+        temp_path.unlink(missing_ok=True)
+
+    with sqlite3.connect(temp_path) as conn:
+        conn.executescript(LEDGER_DB_SCHEMA)
+        if all_data is not None and not all_data.empty:
+            rows = ledger_sql_rows(all_data).drop_duplicates(subset=DUPLICATE_KEY, keep='last')
+            if base_db_path is not None:
+                rows[DUPLICATE_KEY].to_sql('incoming_keys', conn, index=False, if_exists='replace')
+                conn.execute("""
+                    DELETE FROM expenses WHERE rowid IN (
+                        SELECT e.rowid FROM expenses e
+                        JOIN incoming_keys k
+                          ON e.date = k.date AND e.description IS k.description AND e.amount = k.amount
+                    )""")
+                conn.execute("DROP TABLE incoming_keys")
+            rows.to_sql('expenses', conn, index=False, if_exists='append')
+    conn.close()
+    os.replace(temp_path, db_path)
+
+    # Tidy up: only keep the newest few databases
+    old_dbs = sorted(LEDGER_DB_DIR.glob("ledger-*.sqlite"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for old_db in old_dbs[LEDGER_DB_KEEP:]:
+        old_db.unlink(missing_ok=True)
+
+def ensure_ledger_db(file_bytes):
+    """Returns the SQLite copy of a master file, building it from 'Expenses' the first time."""
+    db_path = ledger_db_path(file_bytes)
+    if not db_path.exists():
+        with pd.ExcelFile(BytesIO(file_bytes), engine='openpyxl') as xls:
+            write_ledger_db(db_path, read_expenses_sheet(xls))
+    return db_path
+
+def sync_ledger_db(merged_file_bytes, new_data_df, existing_file_bytes=None, match_across_formats=False):
+    """
+    Prepares the database for a freshly built master straight away:
+    the old master's database (if we have it) plus the new rows.
+    """
+    if match_across_formats:
+        return # The SQL copy only knows exact duplicates; it'll be built from 'Expenses' when this file is uploaded
+    base_db_path = None
+    if existing_file_bytes is not None:
+        base_db_path = ledger_db_path(existing_file_bytes)
+        if not base_db_path.exists():
+            return # Nothing to build on; it'll be built from scratch when this file is uploaded
+
+    new_rows = new_data_df.copy()
+    new_rows['Category'] = new_rows['Category'].fillna("None").replace("", "None")
+    new_rows['date'] = pd.to_datetime(new_rows['date'])
+    new_rows = fill_missing_merchants(new_rows)
+    write_ledger_db(ledger_db_path(merged_file_bytes), new_rows, base_db_path=base_db_path)
+
+def run_ledger_query(db_path, query, max_rows=SQL_MAX_ROWS, timeout_seconds=SQL_TIMEOUT_SECONDS):
+    """
+    Runs a user's query on a READ-ONLY connection (so it can't change anything).
+    Returns the result (at most max_rows rows) and whether it was cut short.
+    Raises TimeoutError if it runs longer than timeout_seconds.
+    """
+    deadline = time.perf_counter() + timeout_seconds
+    conn = sqlite3.connect(f"{Path(db_path).as_uri()}?mode=ro", uri=True)
+    try:
+        # SQLite calls this every few thousand steps; returning True interrupts the query
+        conn.set_progress_handler(lambda: time.perf_counter() > deadline, 10_000)
+        cursor = conn.execute(query)
+        columns = [column[0] for column in cursor.description or []]
+        rows = cursor.fetchmany(max_rows + 1)
+    except sqlite3.OperationalError as e:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"query took longer than {timeout_seconds}s and was stopped") from e
+        raise
+    finally:
+        conn.close()
+    return pd.DataFrame(rows[:max_rows], columns=columns), len(rows) > max_rows
+
+def format_overview_sheet(workbook, worksheet, df_overview, formats):
+    """
+    Dresses up one Overview sheet: colored category headers, the
+    "Total Actual" / "Budget" summary rows and the over-budget highlighting.
+    """
+    from xlsxwriter.utility import xl_col_to_name
+
+    # --- 1. Color the Overview Headers ---
+
+    # Define our pastel colors
+    pastel_colors = [
+        '#E0F7FA', '#E8F5E9', '#FFFDE7', '#FCE4EC',
+        '#F3E5F5', '#E8EAF6', '#E3F2FD', '#E0F2F1'
+    ]
+
+    # Get the category column headers (e.g., ['Food', 'Transport', ...])
+    # We start from column 1 (B)
+    category_headers = df_overview.columns
+
+    for col_num, category_name in enumerate(category_headers, start=1):
+        # Pick a color from our list (and "wrap around" if we run out)
+        color = pastel_colors[col_num % len(pastel_colors)]
+
+        # Create a new format for this header
+        header_format = workbook.add_format({
+            'bold': True,
+            'bg_color': color,
+            'border': 1
+        })
+
+        # Write the header back onto the sheet with the new format
+        worksheet.write(0, col_num, category_name, header_format)
+
+    # --- 2. Add Summary Rows ---
+    # Get the number of rows of data (e.g., 12 months) + 1 for the header
+    num_data_rows = len(df_overview) + 1
+    # Get the number of columns of data (e.g., 5 categories)
+    num_data_cols = len(df_overview.columns)
+
+    # Add a blank spacer row
+    spacer_row = num_data_rows + 1
+
+    # Define summary row numbers
+    actual_row = spacer_row + 1
+    budget_row = actual_row + 1
+
+    # --- Write Summary Row Headers ---
+    worksheet.write(actual_row, 0, 'Total Actual', formats['total_actual_header'])
+    worksheet.write(budget_row, 0, 'Budget', formats['budget_header'])
+
+    # --- Write Summary Row Formulas (for each category column) ---
+    # Loop from the 2nd column (index 1) to the end
+    for col_num in range(1, num_data_cols + 1):
+        col_letter = xl_col_to_name(col_num)
+
+        # 1. Total Actual: =SUM({col_letter}2:{col_letter}{num_data_rows})
+        actual_formula = f'=SUM({col_letter}2:{col_letter}{num_data_rows})'
+        worksheet.write(actual_row, col_num, actual_formula, formats['total_actual'])
+
+        # 2. Budget: =0 (our fail-safe)
+        worksheet.write(budget_row, col_num, 0, formats['budget'])
+
+    # --- 3. Add Conditional Formatting (Per-Cell) ---
+    # Get the range of the main data (e.g., 'B2:F13')
+    start_col_letter = xl_col_to_name(1)
+    end_col_letter = xl_col_to_name(num_data_cols)
+    data_range = f'{start_col_letter}2:{end_col_letter}{num_data_rows}'
+
+    # Get the *first* cell of the budget row (e.g., 'B15')
+    # The $ locks the row, so B2 compares to B$15, C2 compares to C$15
+    budget_cell_locked = f'{start_col_letter}${budget_row + 1}'
+
+    # Apply the format: "Highlight if cell value > its column's budget"
+    worksheet.conditional_format(data_range,
+        {
+            'type': 'formula',
+            # The criteria is '=B2>B$15'
+            # Excel will automatically adjust 'B2' for each cell in the range,
+            # but 'B$15' will "lock" to the correct budget row.
+            'criteria': f'={start_col_letter}2>{budget_cell_locked}',
+            'format': formats['red']
+        }
+    )
+
+    # --- 4. Add formatting for numbers (Vibe Check) ---
+    worksheet.set_column(0, 0, 20, formats['bold']) # Widen the period / Summary header column
+    worksheet.set_column(1, num_data_cols, 18, formats['accounting'])
 
 # --- NEW MASTER "CHEF" FUNCTION (v1.4.0) ---
-def convert_df_to_excel(new_data_df, existing_file_buffer=None):
+def convert_df_to_excel(new_data_df, existing_file_buffer=None, match_across_formats=False):
     """
     This is the new v1.4.0 "Master Chef" converter.
     - It creates a master "Expenses" sheet (raw data).
     - It creates/preserves "Income" sheets for manual entry.
     - It creates "Overview" sheets with budget calculations.
+    match_across_formats turns on the looser duplicate check (see duplicate_keys).
     """
     output_buffer = BytesIO()
     
@@ -265,33 +1442,35 @@ def convert_df_to_excel(new_data_df, existing_file_buffer=None):
     # Convert any NaNs, Nones, or blank strings to the String "None".
     df_expenses_master['Category'] = df_expenses_master['Category'].fillna("None").replace("", "None")
     df_expenses_master['date'] = pd.to_datetime(df_expenses_master['date'])
-    df_expenses_master.sort_values(by='date', ascending=True, inplace=True)
+    # Rows without a merchant (older masters, rows added by hand in the editor) get one now
+    df_expenses_master = fill_missing_merchants(df_expenses_master)
+    # (A *stable* sort keeps new rows after old ones on the same date, so "keep='last'" below means "new data wins")
+    df_expenses_master.sort_values(by='date', ascending=True, inplace=True, kind='stable')
     
     # Drop duplicates
-    df_expenses_master.drop_duplicates(subset=['date', 'description', 'amount'], keep='last', inplace=True)
+    is_duplicate = duplicate_keys(df_expenses_master, match_across_formats).duplicated(keep='last')
+    df_expenses_master = df_expenses_master[~is_duplicate].copy()
 
     # --- VIBE 3: BUILD THE OVERVIEW SHEETS ---
     
     # 1. Create the 'Month' column (e.g., "2025-11") for pivoting
     df_expenses_master['Month'] = pd.to_datetime(df_expenses_master['date']).dt.to_period('M').dt.to_timestamp()
+    # Keep the sheet's columns in a fixed order (A-F), whatever order they came in
+    fixed_columns = ['date', 'description', 'amount', 'Category', 'Month', 'merchant']
+    other_columns = [column for column in df_expenses_master.columns if column not in fixed_columns]
+    df_expenses_master = df_expenses_master[fixed_columns + other_columns]
     
-    # 2. Create the pivot table for "Actual" spend
-    df_monthly_pivot = df_expenses_master.pivot_table(
-        index='Month',
-        columns='Category',
-        values='amount',
-        aggfunc='sum',
-        fill_value=0
-    )
-    df_monthly_pivot = df_monthly_pivot * -1 # Invert values
-    # Convert the sorted date index to the "pretty" string format
-    df_monthly_pivot.index = df_monthly_pivot.index.strftime('%B %Y')
-    
-    # 3. Add our new Budget columns to this pivot table
-    df_monthly_overview = df_monthly_pivot.copy()
-
-
-    # (We will add Weekly, Daily, etc. in a later task)
+    # 2. Build the "Actual" spend pivots for every Overview sheet, all from
+    # one pass over the (merged) ledger. That way hand edits made in Excel,
+    # like a re-categorized row, always show up.
+    overview_pivots = build_period_pivots(df_expenses_master)
+
+    overview_sheets = {}
+    for granularity in PERIOD_GRANULARITIES:
+        df_overview = overview_pivots[granularity].copy()
+        # Convert the sorted date index to the "pretty" string format
+        df_overview.index = format_period_labels(df_overview.index, granularity)
+        overview_sheets[PERIOD_GRANULARITIES[granularity]['sheet']] = df_overview
 
     # --- VIBE 4: WRITE TO "IN-MEMORY" FILE ---
     with pd.ExcelWriter(output_buffer, engine='xlsxwriter') as writer:
@@ -299,27 +1478,34 @@ def convert_df_to_excel(new_data_df, existing_file_buffer=None):
         
         # --- DEFINE ALL FORMATS FIRST ---
         accounting_format = workbook.add_format({'num_format': '_($* #,##0.00_);_($* (#,##0.00);_($* "-"??_);_(@_)'})
-        bold_format = workbook.add_format({'bold': True})
-        
-        # Format for "Total Actual" row
-        total_actual_header_format = workbook.add_format({'bold': True, 'bg_color': '#EEEEEE'})
-        total_actual_format = workbook.add_format({
-            'bold': True, 'bg_color': '#EEEEEE',
-            'num_format': '_($* #,##0.00_);_($* (#,##0.00);_($* "-"??_);_(@_)'
-        })
-        
-        # Format for "Budget" row
-        budget_header_format = workbook.add_format({'bold': True, 'bg_color': '#E8F5E9'})
-        budget_format = workbook.add_format({
-            'bg_color': '#E8F5E9',
-            'num_format': '_($* #,##0.00_);_($* (#,##0.00);_($* "-"??_);_(@_)'
-        })
+        overview_formats = {
+            'accounting': accounting_format,
+            'bold': workbook.add_format({'bold': True}),
+            
+            # Format for "Total Actual" row
+            'total_actual_header': workbook.add_format({'bold': True, 'bg_color': '#EEEEEE'}),
+            'total_actual': workbook.add_format({
+                'bold': True, 'bg_color': '#EEEEEE',
+                'num_format': '_($* #,##0.00_);_($* (#,##0.00);_($* "-"??_);_(@_)'
+            }),
+            
+            # Format for "Budget" row
+            'budget_header': workbook.add_format({'bold': True, 'bg_color': '#E8F5E9'}),
+            'budget': workbook.add_format({
+                'bg_color': '#E8F5E9',
+                'num_format': '_($* #,##0.00_);_($* (#,##0.00);_($* "-"??_);_(@_)'
+            }),
+            
+            # Format for "over budget" cells
+            'red': workbook.add_format({'bg_color': '#FFC7CE'}) # Light red fill
+        }
         
         # --- 1. Write the sheets in the new, correct order ---
         # (This order defines the tabs from left to right)
         
-        # Write Overview sheet FIRST
-        df_monthly_overview.to_excel(writer, sheet_name='Monthly Overview')
+        # Write Overview sheets FIRST (Daily, Weekly, Monthly, ...)
+        for sheet_name, df_overview in overview_sheets.items():
+            df_overview.to_excel(writer, sheet_name=sheet_name)
         
         # Write preserved manual sheets
         preserved_sheets['Income Dashboard'].to_excel(writer, sheet_name='Income Dashboard', index=False)
@@ -330,34 +1516,11 @@ def convert_df_to_excel(new_data_df, existing_file_buffer=None):
 
         # --- 2. Add Formatting & Final Touches ---
         
-        # --- Monthly Overview Formatting ---
-        worksheet_mo = writer.sheets['Monthly Overview']
-        
-        # --- 4. Color the Monthly Overview Headers ---
-        
-        # Define our pastel colors
-        pastel_colors = [
-            '#E0F7FA', '#E8F5E9', '#FFFDE7', '#FCE4EC',
-            '#F3E5F5', '#E8EAF6', '#E3F2FD', '#E0F2F1'
-        ]
-        
-        # Get the category column headers (e.g., ['Food', 'Transport', ...])
-        # We start from column 1 (B)
-        category_headers = df_monthly_overview.columns
-        
-        for col_num, category_name in enumerate(category_headers, start=1):
-            # Pick a color from our list (and "wrap around" if we run out)
-            color = pastel_colors[col_num % len(pastel_colors)]
-            
-            # Create a new format for this header
-            header_format = workbook.add_format({
-                'bold': True,
-                'bg_color': color,
-                'border': 1
-            })
-            
-            # Write the header back onto the sheet with the new format
-            worksheet_mo.write(0, col_num, category_name, header_format)
+        # --- Overview Formatting ---
+        for sheet_name, df_overview in overview_sheets.items():
+            format_overview_sheet(workbook, writer.sheets[sheet_name], df_overview, overview_formats)
+        # Open the workbook on the Monthly Overview, like before
+        writer.sheets['Monthly Overview'].activate()
 
         # --- Expenses Sheet Formatting ---
         worksheet_ex = writer.sheets['Expenses']
@@ -367,12 +1530,13 @@ def convert_df_to_excel(new_data_df, existing_file_buffer=None):
         worksheet_ex.set_column('C:C', 18, accounting_format) # Amount
         worksheet_ex.set_column('D:D', 20) # Category
         worksheet_ex.set_column('E:E', 12) # Month
+        worksheet_ex.set_column('F:F', 25) # Merchant
         
         # Get the dimensions of the data
         (num_rows, num_cols) = df_expenses_master.shape
         
         # Apply the autofilter
-        # This creates the filter dropdowns on all headers (from A1 to E1)
+        # This creates the filter dropdowns on all headers (from A1 to F1)
         worksheet_ex.autofilter(0, 0, num_rows, num_cols - 1)
         
         # --- Income Sheet Formatting ---
@@ -382,71 +1546,32 @@ def convert_df_to_excel(new_data_df, existing_file_buffer=None):
         worksheet_in.set_column('C:C', 18, accounting_format) # Amount
         worksheet_in.set_column('D:D', 40) # Notes
         
-        # --- Add Summary Rows (The new logic) ---
-        # Get the number of rows of data (e.g., 12 months) + 1 for the header
-        num_data_rows = len(df_monthly_overview) + 1
-        # Get the number of columns of data (e.g., 5 categories)
-        num_data_cols = len(df_monthly_overview.columns)
-        
-        # Add a blank spacer row
-        spacer_row = num_data_rows + 1
-        
-        # Define summary row numbers
-        actual_row = spacer_row + 1
-        budget_row = actual_row + 1
-        
-        # --- Write Summary Row Headers ---
-        worksheet_mo.write(actual_row, 0, 'Total Actual', total_actual_header_format)
-        worksheet_mo.write(budget_row, 0, 'Budget', budget_header_format)
-        
-        # --- Write Summary Row Formulas (for each category column) ---
-        # Loop from the 2nd column (index 1) to the end
-        for col_num in range(1, num_data_cols + 1):
-            col_letter = xlsxwriter.utility.xl_col_to_name(col_num)
-            
-            # 1. Total Actual: =SUM({col_letter}2:{col_letter}{num_data_rows})
-            actual_formula = f'=SUM({col_letter}2:{col_letter}{num_data_rows})'
-            worksheet_mo.write(actual_row, col_num, actual_formula, total_actual_format)
-            
-            # 2. Budget: =0 (our fail-safe)
-            worksheet_mo.write(budget_row, col_num, 0, budget_format)
-
-        # --- Add NEW Conditional Formatting (Per-Cell) ---
-        red_format = workbook.add_format({
-            'bg_color': '#FFC7CE',   # Light red fill
-        })
-        
-        # Get the range of the main data (e.g., 'B2:F13')
-        start_col_letter = xlsxwriter.utility.xl_col_to_name(1)
-        end_col_letter = xlsxwriter.utility.xl_col_to_name(num_data_cols)
-        data_range = f'{start_col_letter}2:{end_col_letter}{num_data_rows}'
-        
-        # Get the *first* cell of the budget row (e.g., 'B15')
-        # The $ locks the row, so B2 compares to B$15, C2 compares to C$15
-        # (budget_row is the variable from our existing code)
-        budget_cell_locked = f'{start_col_letter}${budget_row + 1}'
-        
-        # Apply the format: "Highlight if cell value > its column's budget"
-        worksheet_mo.conditional_format(data_range,
-            {
-                'type': 'formula',
-                # The criteria is '=B2>B$15'
-                # Excel will automatically adjust 'B2' for each cell in the range,
-                # but 'B$15' will "lock" to the correct budget row.
-                'criteria': f'={start_col_letter}2>{budget_cell_locked}',
-                'format': red_format
-            }
-        )
-
-        # --- 4. Add formatting for numbers (Vibe Check) ---
-        # accounting_format is already defined at the top of the with block
-
-        worksheet_mo.set_column(0, 0, 20, bold_format) # Widen the 'Month' / Summary header column
-        worksheet_mo.set_column(1, num_data_cols, 18, accounting_format)
-
     # --- VIBE 5: RETURN THE "IN-MEMORY" FILE ---
     return output_buffer.getvalue() # Return the "in-memory" file
 
+def build_excel_file(staging_dir, existing_file_bytes=None, match_across_formats=False):
+    """
+    Runs the "Master Chef" on everything in the staging area. Only called when
+    the user asks for a download, and NOT cached: the whole batch (and the
+    workbook) only lives in memory for as long as that one download needs it.
+    """
+    new_data_df = read_staging_area(staging_dir)
+    if new_data_df is None:
+        new_data_df = pd.DataFrame(columns=STAGING_COLUMNS)
+    existing_file_buffer = BytesIO(existing_file_bytes) if existing_file_bytes is not None else None
+    excel_bytes = convert_df_to_excel(
+        new_data_df.copy(),
+        existing_file_buffer=existing_file_buffer,
+        match_across_formats=match_across_formats
+    )
+
+    # Keep the SQL copy in step with the file we're handing out
+    try:
+        sync_ledger_db(excel_bytes, new_data_df, existing_file_bytes, match_across_formats)
+    except (sqlite3.Error, OSError, ValueError):
+        pass # Not a big deal: it's rebuilt from 'Expenses' when the file is uploaded
+    return excel_bytes
+
 # --- SESSION STATE ---
 if 'app_step' not in st.session_state:
     st.session_state.app_step = "1_upload" # Tracks our app's current step
@@ -454,14 +1579,16 @@ if 'app_step' not in st.session_state:
 if 'stop_ai' not in st.session_state:
     st.session_state.stop_ai = False # Our "emergency brake"
 
-if 'processed_data' not in st.session_state:
-    st.session_state.processed_data = None
-
 if 'categories' not in st.session_state:
     st.session_state.categories = []
 
-if 'all_processed_data' not in st.session_state:
-    st.session_state.all_processed_data = [] # Stores *completed* file data
+if 'staging_dir' not in st.session_state:
+    st.session_state.staging_dir = None # Folder holding *completed* file data (on disk)
+    clear_abandoned_staging_areas() # A new session: tidy up after the ones that have ended
+touch_staging_area(st.session_state.staging_dir)
+
+if 'editor_page' not in st.session_state:
+    st.session_state.editor_page = 1 # Which staged page the editor is showing
 
 if 'file_progress_index' not in st.session_state:
     st.session_state.file_progress_index = 0 # Bookmark for *which file*
@@ -475,8 +1602,42 @@ if 'current_file_data' not in st.session_state:
 if 'uploaded_master_file' not in st.session_state:
     st.session_state.uploaded_master_file = None
 
+if 'run_count' not in st.session_state:
+    st.session_state.run_count = 0 # How many times this script has run for this session
+
+if 'first_run_timings' not in st.session_state:
+    st.session_state.first_run_timings = None # Timings of the session's first ("cold") run
+
+if 'merchant_rules' not in st.session_state:
+    st.session_state.merchant_rules = [] # The user's own "pattern => Merchant" rules (compiled)
+
+if 'merchant_categories' not in st.session_state:
+    st.session_state.merchant_categories = {} # AI answers for this job, one per merchant
 
+if 'token_usage' not in st.session_state:
+    st.session_state.token_usage = new_token_usage() # Tokens used by the current/last AI job
 
+if 'token_window' not in st.session_state:
+    st.session_state.token_window = [] # (time, tokens) of the AI calls in the last minute
+
+if 'tokens_per_minute' not in st.session_state:
+    st.session_state.tokens_per_minute = DEFAULT_TOKENS_PER_MINUTE
+
+if 'requests_per_minute' not in st.session_state:
+    st.session_state.requests_per_minute = DEFAULT_REQUESTS_PER_MINUTE
+
+if 'pdf_fallback_warned' not in st.session_state:
+    st.session_state.pdf_fallback_warned = False # Have we told the user PDFs are using the slow CLI path?
+
+if 'match_across_formats' not in st.session_state:
+    st.session_state.match_across_formats = False # Opt-in: PDF + CSV copies of one transaction count as duplicates
+
+if 'csv_mapping' not in st.session_state:
+    st.session_state.csv_mapping = {'columns': {}, 'flip_sign': False, 'date_order': None} # How to read bank CSV exports
+
+
+
+mark_timing("Page setup & state")
 
 # --- SIDEBAR ---
 st.sidebar.title("App Controls")
@@ -522,13 +1683,82 @@ with st.sidebar.expander("⚙️ Manage Categories"):
     ]
     st.info("Your categories are now saved!")
 
+with st.sidebar.expander("🏦 CSV Import Settings"):
+    st.write("Which columns of your bank's CSV export hold what? Leave a box empty to let the app guess.")
+    csv_date_column = st.text_input("Date column", placeholder="e.g. Transaction Date")
+    csv_description_column = st.text_input("Description column", placeholder="e.g. Payee")
+    csv_amount_column = st.text_input("Amount column", placeholder="e.g. Amount")
+    csv_date_order = st.selectbox(
+        "Date order",
+        options=list(CSV_DATE_ORDERS),
+        help="Only needed when the app can't tell, e.g. a file where every date looks like 05/03/2025."
+    )
+    csv_flip_sign = st.checkbox("My bank shows spending as positive numbers")
+    st.session_state.csv_mapping = {
+        'columns': {
+            'date': csv_date_column,
+            'description': csv_description_column,
+            'amount': csv_amount_column
+        },
+        'flip_sign': csv_flip_sign,
+        'date_order': CSV_DATE_ORDERS[csv_date_order]
+    }
+    st.session_state.match_across_formats = st.checkbox(
+        "When merging, treat a PDF row and a CSV/OFX/QIF row as the same transaction if only the card prefix or location differs",
+        help="e.g. 'SQ *STARBUCKS #12 SEATTLE WA' and 'STARBUCKS #12' on the same day for the same amount. "
+             "Off by default: normally only identical descriptions count as duplicates."
+    )
+
+with st.sidebar.expander("🤖 AI Token Budget"):
+    st.session_state.tokens_per_minute = st.number_input(
+        "Max tokens per minute:",
+        min_value=1_000,
+        value=DEFAULT_TOKENS_PER_MINUTE,
+        step=10_000,
+        help="The AI slows down to stay under this. Match it to your Gemini quota."
+    )
+    st.session_state.requests_per_minute = st.number_input(
+        "Max AI calls per minute:",
+        min_value=1,
+        value=DEFAULT_REQUESTS_PER_MINUTE,
+        step=5,
+        help="Gemini also limits how many calls you make per minute (RPM). Match it to your quota."
+    )
+    pace = seconds_per_ai_call(st.session_state.token_usage, st.session_state.tokens_per_minute, st.session_state.requests_per_minute)
+    st.caption(f"That's about one AI call every {pace:.1f}s.")
+    if st.session_state.token_usage['calls']:
+        st.markdown("Last AI job: " + describe_token_usage(st.session_state.token_usage))
+
+with st.sidebar.expander("🏷️ Merchant Rules"):
+    st.write("Merchant names are cleaned up automatically. Add your own rules (one per line) to group things your way:")
+    merchant_rules_input = st.text_area(
+        "Your rules (pattern => Merchant Name):",
+        value="",
+        placeholder="AMZN|AMAZON => AMAZON\nUBER\s*\*?\s*EATS => UBER EATS",
+        height=120
+    )
+    st.session_state.merchant_rules, merchant_rule_problems = parse_merchant_rules(merchant_rules_input)
+    for problem in merchant_rule_problems:
+        st.warning(f"Skipped rule {problem}")
+    st.caption("Rules are applied when new statements are processed.")
+
+with st.sidebar.expander("⏱️ Performance"):
+    # Filled in at the very end of the script, once we know how long this run took
+    timing_report_placeholder = st.empty()
+
+mark_timing("Sidebar")
+
 # --- MAIN APP ---
 st.title("Woshi's Tracker App")
 tab1, tab2 = st.tabs(["🗃️ Data Processing", "📊 Dashboard"])
 
 with tab1:
     st.write("Welcome to my app! Let's get those finances organized.")
-    uploaded_files = st.file_uploader("Upload your PDF bank statements here:", accept_multiple_files=True, type="pdf")
+    uploaded_files = st.file_uploader(
+        "Upload your bank statements here (PDF, or CSV/OFX/QFX/QIF exports):",
+        accept_multiple_files=True,
+        type=["pdf", "csv", "ofx", "qfx", "qif"]
+    )
 
 
 
@@ -550,7 +1780,10 @@ with tab1:
             st.session_state.stop_ai = False # Ensure brake is off
             
             # --- RESET BOOKMARKS FOR NEW JOB ---
-            st.session_state.all_processed_data = [] 
+            st.session_state.staging_dir = start_staging_area(st.session_state.staging_dir)
+            # Recurring charges we already know about are labelled up front (they never go to the AI)
+            st.session_state.merchant_categories = recurring_labels_from_master(st.session_state.categories)
+            st.session_state.token_usage = new_token_usage()
             st.session_state.file_progress_index = 0
             st.session_state.row_progress_index = 0
             # --- END RESET ---
@@ -559,6 +1792,7 @@ with tab1:
 
         if col2.button("Skip (I'll categorize manually)"):
             st.session_state.app_step = "3_process_no_ai"
+            st.session_state.token_usage = new_token_usage()
             st.rerun()
 
     # --- STEP 3A: PROCESS *WITH* AI (FIXED STATE LOGIC) ---
@@ -566,6 +1800,7 @@ with tab1:
         
         eta_placeholder = st.empty()
         row_timer_placeholder = st.empty()
+        token_placeholder = st.empty()
         progress_bar = st.progress(0, text="Starting AI process...")
         
         if st.button("Stop AI ⏹️"):
@@ -588,24 +1823,20 @@ with tab1:
                 # --- 1. GET THE *CORRECT* FILE DATA FIRST ---
                 if st.session_state.row_progress_index == 0: 
                     with st.spinner(f"Processing `{file.name}` ({current_file_index+1}/{total_files})..."):
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            temp_dir_path = Path(temp_dir)
-                            input_pdf_path = temp_dir_path / file.name
-                            input_pdf_path.write_bytes(file.getvalue())
-
-                            command = ["monopoly", str(input_pdf_path), "-o", str(temp_dir_path)]
-                            subprocess.run(command, check=True, capture_output=True, text=True)
-
-                            csv_files = list(temp_dir_path.glob("*.csv"))
-                            if not csv_files:
-                                st.warning(f"Could not find CSV for {file.name}, skipping.")
-                                st.session_state.file_progress_index = current_file_index + 1
-                                continue # Skip to the next file
-                                
-                            data = pd.read_csv(csv_files[0])
+                        try:
+                            data = parse_statement(file, st.session_state.csv_mapping)
+                            problem = "no transactions found"
+                        except ValueError as e:
+                            data, problem = None, e
+
+                        if data is None:
+                            st.warning(f"Could not read `{file.name}` ({problem}), skipping.")
+                            st.session_state.file_progress_index = current_file_index + 1
+                            continue # Skip to the next file
                         
                         columns_to_keep = ['date', 'description', 'amount']
                         preview_data = data[columns_to_keep].copy()
+                        preview_data['merchant'] = normalize_merchants(preview_data['description'], st.session_state.merchant_rules)
                         preview_data['Category'] = "" # Start with blank
                         st.session_state.current_file_data = preview_data 
                 else:
@@ -613,7 +1844,6 @@ with tab1:
 
                 # --- 2. Run the AI Loop (if "Stop" is not pressed) ---
                 num_rows = len(preview_data)
-                time_per_row = 4.1 
                 row_bookmark = st.session_state.row_progress_index
 
                 for index, row in preview_data.iloc[row_bookmark:].iterrows():
@@ -622,22 +1852,41 @@ with tab1:
                     if st.session_state.stop_ai:
                         break # Stop this *inner* AI loop
                     
-                    # (Timers)
-                    rows_left = num_rows - st.session_state.row_progress_index
-                    total_eta_seconds = rows_left * time_per_row
+                    # (Timers) - we only wait on the AI for merchants it hasn't seen yet
+                    rows_left = preview_data['merchant'].iloc[st.session_state.row_progress_index:]
+                    ai_calls_left = rows_left[~rows_left.isin(list(st.session_state.merchant_categories))].nunique()
+                    time_per_call = seconds_per_ai_call(
+                        st.session_state.token_usage,
+                        st.session_state.tokens_per_minute,
+                        st.session_state.requests_per_minute
+                    )
+                    total_eta_seconds = ai_calls_left * time_per_call
                     eta_text = format_time(total_eta_seconds)
                     eta_placeholder.markdown(f"#### Processing `{file.name}` ({current_file_index+1}/{total_files})")
                     progress_bar.progress((st.session_state.row_progress_index + 1) / num_rows, text=f"Est. Time Remaining: {eta_text}")
                     
-                    guess = get_ai_category(row['description'], st.session_state.categories)
-                    preview_data.at[index, 'Category'] = guess
-                    st.session_state.current_file_data = preview_data
-                    
-                    # (Row Countdown Timer)
-                    for t in range(int(time_per_row), 0, -1):
-                        row_timer_placeholder.info(f"Categorizing: `{row['description'][:30]}...` (Waiting for quota... {t}s)")
-                        time.sleep(1)
-                    time.sleep(time_per_row - int(time_per_row))
+                    merchant = row['merchant']
+                    if merchant in st.session_state.merchant_categories:
+                        # Same merchant as an earlier row: reuse the answer, no AI call (and no waiting!)
+                        preview_data.at[index, 'Category'] = st.session_state.merchant_categories[merchant]
+                        st.session_state.current_file_data = preview_data
+                    else:
+                        # No fixed sleep: we only wait when the per-minute budgets say so
+                        wait_for_ai_budget(st.session_state.tokens_per_minute, st.session_state.requests_per_minute, row_timer_placeholder)
+                        row_timer_placeholder.info(f"Categorizing: `{merchant[:30]}...`")
+                        guess = get_ai_category(merchant, st.session_state.categories)
+                        token_placeholder.caption(
+                            describe_token_usage(st.session_state.token_usage)
+                            + f" · last call {st.session_state.token_usage['last_call']:,}"
+                        )
+                        if guess is None:
+                            # The call failed: mark this row "None" but don't remember it,
+                            # so the merchant's next row gets another try
+                            guess = "None"
+                        else:
+                            st.session_state.merchant_categories[merchant] = guess
+                        preview_data.at[index, 'Category'] = guess
+                        st.session_state.current_file_data = preview_data
                     
                     st.session_state.row_progress_index = preview_data.index.get_loc(index) + 1
 
@@ -649,7 +1898,8 @@ with tab1:
                     current_data = st.session_state.current_file_data
                     current_data['Category'] = current_data['Category'].replace("", "None")
                     st.session_state.current_file_data = current_data
-                st.session_state.all_processed_data.append(st.session_state.current_file_data)
+                # Spill the finished file to disk, so memory only ever holds *one* file
+                stage_file_result(st.session_state.staging_dir, current_file_index, st.session_state.current_file_data)
                 st.session_state.file_progress_index = current_file_index + 1
                 st.session_state.row_progress_index = 0
                 st.session_state.current_file_data = None 
@@ -657,22 +1907,24 @@ with tab1:
             # --- 4. Finalize (After *outer* loop) ---
             eta_placeholder.empty()
             row_timer_placeholder.empty()
+            token_placeholder.empty()
             progress_bar.empty()
             
-            if not st.session_state.all_processed_data:
+            # The staged pages ARE the result: the editor and the downloads read them from disk
+            if not list_staged_pages(st.session_state.staging_dir):
                 st.error("No data was processed.")
                 st.session_state.app_step = "1_upload"
+                clear_staging_area(st.session_state.staging_dir)
+                st.session_state.staging_dir = None
             else:
-                final_data = pd.concat(st.session_state.all_processed_data, ignore_index=True)
-                st.session_state.processed_data = final_data
                 st.success("Processing complete! (AI was stopped early)") if st.session_state.stop_ai else st.success("AI categorization complete!")
+                st.session_state.editor_page = 1
                 st.session_state.app_step = "4_display"
 
             # Reset bookmarks for the *next* full job
             st.session_state.file_progress_index = 0
             st.session_state.row_progress_index = 0
             st.session_state.stop_ai = False
-            st.session_state.all_processed_data = []
             st.session_state.current_file_data = None
             st.rerun()
 
@@ -680,38 +1932,68 @@ with tab1:
             st.error(f"An error occurred while processing: {e.stderr}")
             # Reset everything on failure
             st.session_state.app_step = "1_upload"
-            st.session_state.processed_data = None
             st.session_state.file_progress_index = 0
             st.session_state.row_progress_index = 0
-            st.session_state.all_processed_data = []
+            clear_staging_area(st.session_state.staging_dir)
+            st.session_state.staging_dir = None
             st.session_state.current_file_data = None
 
     # --- STEP 3B: PROCESS *WITHOUT* AI ---
     if st.session_state.app_step == "3_process_no_ai":
         try:
+            st.session_state.staging_dir = start_staging_area(st.session_state.staging_dir)
             with st.spinner("Processing files (skipping AI)..."):
-                data = process_files_to_dataframe(uploaded_files)
+                # Categories stay "None", except for recurring charges we already know from the master file
+                staged_rows = process_files_to_staging(
+                    uploaded_files,
+                    st.session_state.staging_dir,
+                    csv_mapping=st.session_state.csv_mapping,
+                    merchant_rules=st.session_state.merchant_rules,
+                    known_labels=recurring_labels_from_master(st.session_state.categories)
+                )
             
-            if data is not None:
+            if staged_rows:
                 st.success("Files processed! Skipping AI categorization.")
-                columns_to_keep = ['date', 'description', 'amount']
-                preview_data = data[columns_to_keep].copy()
-                preview_data['Category'] = "None" # Leave category blank as requested
-                
-                st.session_state.processed_data = preview_data
+                st.session_state.editor_page = 1
                 st.session_state.app_step = "4_display"
                 st.rerun()
+            else:
+                st.error("No data was processed.")
+                clear_staging_area(st.session_state.staging_dir)
+                st.session_state.staging_dir = None
+                st.session_state.app_step = "1_upload"
                 
         except subprocess.CalledProcessError as e:
             st.error(f"An error occurred while processing: {e.stderr}")
+            clear_staging_area(st.session_state.staging_dir)
+            st.session_state.staging_dir = None
             st.session_state.app_step = "1_upload"
 
     # --- STEP 4: DISPLAY THE EDITOR ---
-    if st.session_state.app_step == "4_display" and st.session_state.processed_data is not None:
+    staged_pages = list_staged_pages(st.session_state.staging_dir)
+    if st.session_state.app_step == "4_display" and not staged_pages:
+        # The staging folder is gone (e.g. this tab sat idle long enough to be tidied up)
+        st.warning("Your processed transactions are no longer available. Please process your files again.")
+        st.session_state.staging_dir = None
+        st.session_state.app_step = "1_upload"
+
+    if st.session_state.app_step == "4_display" and staged_pages:
         st.subheader("Preview, Edit, and Finalize Your Transactions:")
+        if st.session_state.token_usage['calls']:
+            st.caption("AI usage for this batch: " + describe_token_usage(st.session_state.token_usage))
+
+        # --- 1. PICK A PAGE (the editor only ever holds one staged page) ---
+        if len(staged_pages) > 1:
+            st.number_input(
+                f"Page (of {len(staged_pages)}, up to {STAGING_PAGE_ROWS:,} transactions each):",
+                min_value=1,
+                max_value=len(staged_pages),
+                key="editor_page"
+            )
+        page_path = staged_pages[min(st.session_state.editor_page, len(staged_pages)) - 1]
 
         # FIX: Convert ALL blanks/NaNs/Nones to the String "None"
-        data_for_editor = st.session_state.processed_data.copy()
+        data_for_editor = read_staged_page(page_path)
         data_for_editor['Category'] = data_for_editor['Category'].fillna("None").replace("", "None")
 
 
@@ -745,10 +2027,10 @@ with tab1:
 
         # --- 4. THE "SAVE" LOGIC ---
         if submitted:
-            # On save, the data (which now contains `None`)
-            # is saved directly to the state.
+            # On save, the page (which now contains `None`)
+            # is written straight back to its staged file.
             # We no longer need to convert it back to "".
-            st.session_state.processed_data = configured_editor
+            write_staged_page(page_path, configured_editor)
             st.success("Changes saved!")
             st.rerun()
 
@@ -759,23 +2041,29 @@ with tab1:
         st.subheader("Your Data is Ready!")
         st.write("You can now download your processed transactions.")
         
-        # Get our "magic whiteboard" data
-        final_data_to_save = st.session_state.processed_data
-        
+        # The spreadsheets are only built when you ask for one (each build reads
+        # *every* page from the staging area), and the download button then
+        # doesn't rerun the app, so nothing gets built twice.
         col1, col2 = st.columns(2)
 
         # --- Button 1: Download as New ---
         with col1:
-            # Call the "Master Chef" with *only* new data
-            excel_data_new = convert_df_to_excel(final_data_to_save, existing_file_buffer=None)
-            
-            st.download_button(
-                label="Download as New Spreadsheet",
-                data=excel_data_new,
-                file_name="master_spreadsheet_new.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                type="primary"
-            )
+            if st.button("Build New Spreadsheet", type="primary"):
+                with st.spinner("Building your spreadsheet..."):
+                    # Call the "Master Chef" with *only* new data
+                    excel_data_new = build_excel_file(
+                        st.session_state.staging_dir,
+                        match_across_formats=st.session_state.match_across_formats
+                    )
+                
+                st.download_button(
+                    label="Download as New Spreadsheet",
+                    data=excel_data_new,
+                    file_name="master_spreadsheet_new.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    on_click="ignore",
+                    type="primary"
+                )
 
         # --- Button 2: Merge & Download ---
         with col2:
@@ -783,27 +2071,34 @@ with tab1:
             uploaded_file = st.session_state.uploaded_master_file
             
             if uploaded_file:
-                # Call the "Master Chef" with *both* new data and the old file
-                excel_data_merged = convert_df_to_excel(final_data_to_save, existing_file_buffer=uploaded_file)
-                
-                st.download_button(
-                    label="Merge & Download",
-                    data=excel_data_merged,
-                    file_name="master_spreadsheet_merged.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+                if st.button("Merge with Uploaded Master"):
+                    with st.spinner("Merging with your master file..."):
+                        # Call the "Master Chef" with *both* new data and the old file
+                        excel_data_merged = build_excel_file(
+                            st.session_state.staging_dir,
+                            uploaded_file.getvalue(),
+                            match_across_formats=st.session_state.match_across_formats
+                        )
+                    
+                    st.download_button(
+                        label="Merge & Download",
+                        data=excel_data_merged,
+                        file_name="master_spreadsheet_merged.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        on_click="ignore"
+                    )
             else:
                 # If no file, show a "disabled" vibe
                 st.button("Merge with Uploaded Master", disabled=True, help="Please upload a 'master_spreadsheet.xlsx' to enable merging.")
 
         if st.button("Process New Files"):
              # Reset everything
-            st.session_state.processed_data = None
             st.session_state.app_step = "1_upload"
             st.session_state.stop_ai = False
             
             # --- ADD THESE RESETS ---
-            st.session_state.all_processed_data = []
+            clear_staging_area(st.session_state.staging_dir)
+            st.session_state.staging_dir = None
             st.session_state.file_progress_index = 0
             st.session_state.row_progress_index = 0
             st.session_state.current_file_data = None
@@ -811,60 +2106,84 @@ with tab1:
             
             st.rerun()
 
+mark_timing("Data Processing tab")
+
 with tab2:
     st.subheader("My Financial Dashboard")
     
     # --- NEW v1.4.0 "CLOUD-VIBE" LOGIC ---
     if st.session_state.uploaded_master_file is None:
         st.info("Upload your 'master_spreadsheet.xlsx' in the 'Data Processing' tab to see your dashboard.")
-        all_data = pd.DataFrame() 
+        rollup = pd.DataFrame() 
 
     else:
-        # We have a file! Let's *try* to read *only* the 'Expenses' sheet.
+        # We have a file! Let's *try* to read its 'Expenses' sheet and roll it up.
         uploaded_file = st.session_state.uploaded_master_file
-        uploaded_file.seek(0) # Reset buffer
         
         try:
             st.success(f"Dashboard loaded from `{uploaded_file.name}`!")
-            # Load *only* the 'Expenses' sheet for our dashboard data
-            all_data = pd.read_excel(uploaded_file, sheet_name="Expenses", engine='openpyxl')
-            
-            # FIX: The Dashboard crashes if categories are NaN/Blank.
-            # We force ALL categories to be strings. If they are NaN, they become "None".
-            all_data['Category'] = all_data['Category'].fillna("None").astype(str)
-            all_data['Category'] = all_data['Category'].replace("", "None")
-            
-            # Ensure 'amount' is numeric, just in case
-            all_data['amount'] = pd.to_numeric(all_data['amount'], errors='coerce')
-            all_data.dropna(subset=['amount'], inplace=True)
-            
-            # Ensure 'date' is datetime
-            all_data['date'] = pd.to_datetime(all_data['date'])
+            rollup = load_dashboard_rollup(uploaded_file.getvalue())
 
         except Exception as e:
             st.error(f"Error reading `Expenses` sheet from `{uploaded_file.name}`: {e}")
             st.info("The file might be corrupt, or the 'Expenses' sheet may be missing.")
-            all_data = pd.DataFrame()
+            rollup = pd.DataFrame()
+
+    # --- ALL OUR "VIBE" CHARTS (Now powered by the Month x Category rollup) ---
+    is_filtered = False
+    if not rollup.empty:
+
+        # --- 0. FILTERS (Date range + Categories) ---
+        min_date = rollup['first_date'].min().date()
+        max_date = rollup['last_date'].max().date()
+        all_categories = sorted(rollup['Category'].unique())
+
+        filter_col1, filter_col2 = st.columns(2)
+        picked_dates = filter_col1.date_input(
+            "Date range",
+            value=(min_date, max_date),
+            min_value=min_date,
+            max_value=max_date,
+            key="dashboard_date_range"
+        )
+        picked_categories = filter_col2.multiselect(
+            "Categories (leave empty for all)",
+            options=all_categories,
+            key="dashboard_categories"
+        )
+
+        # While the user is halfway through picking a range we only get one date back
+        if isinstance(picked_dates, (tuple, list)) and len(picked_dates) == 2:
+            start_date, end_date = picked_dates
+        else:
+            start_date, end_date = min_date, max_date
+
+        is_filtered = (start_date, end_date) != (min_date, max_date) or bool(picked_categories)
+        if is_filtered:
+            # Only now do we need the raw transactions: slice the (cached) index
+            # and roll up just that slice.
+            ledger_index = load_ledger_index(st.session_state.uploaded_master_file.getvalue())
+            filtered_data = filter_ledger(ledger_index, start_date, end_date, picked_categories)
+            rollup = build_rollup(filtered_data)
 
-    # --- ALL OUR "VIBE" CHARTS (Now powered by 'Expenses' sheet) ---
-    if not all_data.empty:
+    if not rollup.empty:
         
         # --- 1. CALCULATE METRICS (The *Correct* Way) ---
         
         # This is the fix: Only sum the 'amount' column!
-        total_spent = all_data['amount'].sum() 
+        total_spent = rollup['amount'].sum() 
         
         # Multiply by -1 to show positive spending
         total_spent_positive = total_spent * -1 
         
         # Group by Category, sum *only* the 'amount'
-        category_totals = all_data.groupby('Category')['amount'].sum() * -1
+        category_totals = rollup.groupby('Category')['amount'].sum() * -1
         
         top_category = category_totals.idxmax()
         top_category_value = category_totals.max()
         
         # Get date range for "avg per month"
-        num_months = (all_data['date'].max() - all_data['date'].min()).days / 30.44
+        num_months = (rollup['last_date'].max() - rollup['first_date'].min()).days / 30.44
         num_months = max(1, num_months) # Avoid division by zero
         avg_per_month = total_spent_positive / num_months
 
@@ -886,30 +2205,149 @@ with tab2:
         st.header("The Spending Pie")
         colA, colB = st.columns(2)
         with colA:
+            import altair as alt # Only loaded once there's actually a chart to draw
             pie_data = category_totals.reset_index(name='Total')
+            # Clicking a slice selects that category (for the drill-down below)
+            category_pick = alt.selection_point(name="category_pick", fields=["Category"])
             donut_chart = alt.Chart(pie_data).mark_arc(outerRadius=120, innerRadius=80).encode(
                 theta=alt.Theta("Total:Q", stack=True), 
                 color=alt.Color("Category:N"),
+                opacity=alt.condition(category_pick, alt.value(1.0), alt.value(0.4)),
                 order=alt.Order("Total", sort="descending"),
                 tooltip=["Category", alt.Tooltip("Total", format="$,.2f")]
-            ).properties(title="Spending Breakdown by Category")
-            st.altair_chart(donut_chart, use_container_width=True)
+            ).add_params(category_pick).properties(title="Spending Breakdown by Category")
+            donut_event = st.altair_chart(donut_chart, use_container_width=True, on_select="rerun", key="donut_chart")
 
         # --- 4. DISPLAY "THE FINANCIAL HEARTBEAT" ---
         with colB:
             st.header("The Financial Heartbeat")
-            st.write("Your total spending, month by month.")
+            granularity = st.radio(
+                "Show spending by:",
+                options=list(PERIOD_GRANULARITIES),
+                index=list(PERIOD_GRANULARITIES).index('Monthly'),
+                horizontal=True,
+                key="heartbeat_granularity"
+            )
+            
+            if granularity in ('Daily', 'Weekly'):
+                # Finer than a month: we need the actual transactions (from the cached index)
+                ledger_index = load_ledger_index(st.session_state.uploaded_master_file.getvalue())
+                heartbeat_source = filter_ledger(ledger_index, start_date, end_date, picked_categories)
+            else:
+                # Monthly and coarser fold straight out of the rollup
+                heartbeat_source = rollup.rename(columns={'Month': 'date'})
+            period_pivot = build_period_pivots(heartbeat_source, [granularity])[granularity]
             
-            # Resample the raw data by month
-            monthly_totals = all_data.set_index('date')['amount'].resample('M').sum() * -1
-            heartbeat_data = pd.DataFrame(monthly_totals)
-            heartbeat_data.index.name = 'Month'
+            # One bar per period (periods with no spending still show up as 0)
+            period_totals = period_pivot.sum(axis=1)
+            settings = PERIOD_GRANULARITIES[granularity]
+            all_periods = pd.date_range(period_totals.index.min(), period_totals.index.max(), freq=settings['freq'])
+            heartbeat_data = pd.DataFrame({'amount': period_totals.reindex(all_periods, fill_value=0)})
+            heartbeat_data.index.name = settings['index']
             
             st.bar_chart(heartbeat_data, use_container_width=True, color="#00f2c3")
+
+        # --- 5. DRILL-DOWN (Click a slice of the pie) ---
+        picked_slices = donut_event.selection.get("category_pick", [])
+        drill_categories = [point["Category"] for point in picked_slices if "Category" in point]
+        if drill_categories:
+            st.divider()
+            st.header(f"Drill-down: {', '.join(drill_categories)}")
+            ledger_index = load_ledger_index(st.session_state.uploaded_master_file.getvalue())
+            drill_data = filter_ledger(ledger_index, start_date, end_date, drill_categories)
+            st.write(f"{len(drill_data)} transaction(s) between {start_date:%d %b %Y} and {end_date:%d %b %Y}.")
+            st.dataframe(
+                drill_data[['date', 'description', 'merchant', 'amount', 'Category']],
+                hide_index=True,
+                use_container_width=True,
+                column_config={
+                    "date": st.column_config.DateColumn("Date", format="DD-MM-YYYY"),
+                    "amount": st.column_config.NumberColumn("Amount", format="$%.2f")
+                }
+            )
+
+        # --- 6. RECURRING CHARGES ---
+        st.divider()
+        st.header("Recurring Charges")
+        recurring = load_recurring_charges(st.session_state.uploaded_master_file.getvalue())
+        if recurring.empty:
+            st.info("No recurring charges found yet (we need a few months of history).")
+        else:
+            active_recurring = recurring[recurring['Active']]
+            # Roughly what the active ones cost per month
+            per_month = {'Weekly': 52 / 12, 'Monthly': 1, 'Yearly': 1 / 12}
+            monthly_cost = (active_recurring['Typical Amount'] * active_recurring['Frequency'].map(per_month)).sum()
+            col1, col2 = st.columns(2)
+            with col1:
+                with st.container(border=True):
+                    st.metric("Active Recurring Charges", f"{len(active_recurring)}")
+            with col2:
+                with st.container(border=True):
+                    st.metric("Est. Monthly Cost", f"${monthly_cost:,.2f}")
+            st.dataframe(
+                recurring,
+                hide_index=True,
+                use_container_width=True,
+                column_config={
+                    "Typical Amount": st.column_config.NumberColumn("Typical Amount", format="$%.2f"),
+                    "Last Charge": st.column_config.DateColumn("Last Charge", format="DD-MM-YYYY"),
+                    "Next Expected": st.column_config.DateColumn("Next Expected", format="DD-MM-YYYY")
+                }
+            )
+            st.caption("New transactions from these merchants are labelled automatically and skip the AI.")
+
+        # --- 7. ASK YOUR LEDGER (SQL) ---
+        st.divider()
+        st.header("Ask Your Ledger")
+        with st.expander("🧮 Run a query on all your transactions (SQL)"):
+            st.caption(
+                "Table `expenses` has the columns: date ('YYYY-MM-DD'), month ('YYYY-MM'), "
+                "description, merchant, amount (negative = spent) and category."
+            )
+            saved_query_name = st.selectbox("Start from a saved query:", options=list(SAVED_SQL_QUERIES), key="saved_sql_query")
+            with st.form(key="sql_form"):
+                sql_query = st.text_area("Query", value=SAVED_SQL_QUERIES[saved_query_name].strip(), height=200)
+                run_query = st.form_submit_button("Run Query")
+
+            if run_query:
+                try:
+                    with st.spinner("Running query..."):
+                        db_path = ensure_ledger_db(st.session_state.uploaded_master_file.getvalue())
+                        query_started_at = time.perf_counter()
+                        query_result, was_cut_short = run_ledger_query(db_path, sql_query)
+                        query_ms = (time.perf_counter() - query_started_at) * 1000
+                    st.caption(f"{len(query_result):,} row(s) in {query_ms:,.1f} ms" + (f" (showing the first {SQL_MAX_ROWS:,})" if was_cut_short else ""))
+                    st.dataframe(query_result, hide_index=True, use_container_width=True)
+                except TimeoutError as e:
+                    st.error(f"Query timed out: {e}")
+                except sqlite3.Error as e:
+                    st.error(f"Query failed: {e}")
+                except Exception as e:
+                    # e.g. the 'Expenses' sheet couldn't be read to build the database
+                    st.error(f"Couldn't prepare your ledger for querying: {e}")
     else:
-        if st.session_state.uploaded_master_file is not None:
+        if is_filtered:
+            # The file is fine, the filters just don't match anything
+            st.info("No transactions match your filters.")
+        elif st.session_state.uploaded_master_file is not None:
             # This catches the case where the file was *bad*
             st.warning("Could not read any 'Expenses' data from the uploaded file.")
         else:
             # This is the normal "empty" state
-            st.info("Your dashboard is empty.")
\ No newline at end of file
+            st.info("Your dashboard is empty.")
+
+# --- TIMING REPORT ---
+mark_timing("Dashboard tab")
+st.session_state.run_count += 1
+if st.session_state.first_run_timings is None:
+    st.session_state.first_run_timings = dict(run_timings)
+
+with timing_report_placeholder.container():
+    this_run = "Cold start (first run)" if st.session_state.run_count == 1 else f"Rerun #{st.session_state.run_count - 1}"
+    timing_rows = pd.DataFrame({
+        "This run (ms)": pd.Series(run_timings) * 1000,
+        "Cold start (ms)": pd.Series(st.session_state.first_run_timings) * 1000
+    })
+    timing_rows.loc["Total"] = timing_rows.sum()
+    st.caption(f"{this_run}: {timing_rows.loc['Total', 'This run (ms)']:,.0f} ms")
+    st.dataframe(timing_rows.round(1), use_container_width=True)